@@ -4,13 +4,15 @@ from mcdreforged.api.all import *
 
 from better_backup.config import config
 from better_backup.constants import OLD_METADATA_DIR, PREFIX, server_inst
-from better_backup.database import database
+from better_backup.database import database, is_table
 from better_backup.operations import (confirm_restore, create_backup,
-                                      export_backup, init_structure,
+                                      export_backup, gc_backup, init_structure,
                                       list_backups, lock_backup,
-                                      operation_lock, remove_backup,
-                                      reset_cache, restore_backup,
-                                      trigger_abort, game_save_triggered)
+                                      operation_lock, rebuild_stats,
+                                      remove_backup, repack_backup,
+                                      reset_cache, restore_backup, show_stats,
+                                      train_dicts, trigger_abort,
+                                      verify_backup, game_save_triggered)
 from better_backup.timer import timer
 from better_backup.utils import *
 
@@ -120,6 +122,11 @@ def register_command(server: PluginServerInterface):
                 .runs(lambda src, ctx: list_backups(src, ctx["page"]))
             )
         )
+        .then(
+            get_literal_node("stats")
+            .runs(lambda src: show_stats(src))
+            .then(Text("uuid|index").runs(lambda src, ctx: show_stats(src, ctx["uuid|index"])))
+        )
         .then(get_literal_node("confirm").runs(confirm_restore))
         .then(get_literal_node("abort").runs(trigger_abort))
         .then(
@@ -129,6 +136,18 @@ def register_command(server: PluginServerInterface):
         )
         .then(get_literal_node("help").runs(lambda src: print_help_message(src)))
         .then(get_literal_node("reset").runs(lambda src: reset_cache(src)))
+        .then(get_literal_node("gc").runs(lambda src: gc_backup(src)))
+        .then(get_literal_node("repack").runs(lambda src: repack_backup(src)))
+        .then(
+            get_literal_node("verify")
+            .runs(lambda src: verify_backup(src))
+            .then(Text("uuid|index|all").runs(lambda src, ctx: verify_backup(src, ctx["uuid|index|all"])))
+        )
+        .then(
+            get_literal_node("train")
+            .runs(lambda src: train_dicts(src))
+            .then(Text("uuid|index").runs(lambda src, ctx: train_dicts(src, ctx["uuid|index"])))
+        )
         .then(
             get_literal_node("export")
             .runs(lambda src: export_backup(src))
@@ -176,6 +195,18 @@ def on_info(server: PluginServerInterface, info: Info):
         if info.content in config.saved_output:
             game_save_triggered()
 
+
+def on_player_joined(server: PluginServerInterface, player: str, info: Info):
+    timer.on_player_joined(player)
+
+
+def on_player_left(server: PluginServerInterface, player: str):
+    timer.on_player_left(player)
+
+
+def on_server_startup(server: PluginServerInterface):
+    timer.on_server_startup()
+
 def on_load(server: PluginServerInterface, old):
     global operation_lock
     init_structure(config.backup_data_path)
@@ -187,9 +218,11 @@ def on_load(server: PluginServerInterface, old):
         operation_lock = old.operation_lock
     if (
         os.path.isdir(os.path.join(config.backup_data_path, OLD_METADATA_DIR))
-        or not database(database.files.hash_type=="md5").isempty()
+        or is_table("files") and not database(database.files.hash_type=="md5").isempty()  # kept as a table by migrate
     ):
         raise MetadataError(tr("metadata_conflict"))
+    if get_stat("cache_size") is None and not database(database.backups).isempty():
+        rebuild_stats(server.get_plugin_command_source())
     server.register_help_message(PREFIX, tr("help_title"))
     server.logger.info("Better Backup Loaded!")
 
@@ -0,0 +1,100 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Optional, Tuple
+
+from better_backup.database import hash_id
+
+BLOB_INDEX_MERGE_MIN = 4096  # blobs added before they are merged into the sorted arrays
+
+
+class BlobIndex:
+    """
+    hash -> (stored size or None if not known yet, compressed) of the blob files in the cache folder.
+    hashes are kept as the int64 sqlite stores, sorted, with parallel size and flag arrays looked up with bisect:
+    17 bytes a blob. blobs added later wait in a small dict until there are enough to merge them
+    """
+
+    def __init__(self, blobs: Iterable[Tuple[int, Optional[int], bool]] = ()):
+        """blobs are (hash id, stored size or None, compressed)"""
+        self.hashes = array("q")
+        self.sizes = array("q")  # -1 if not known yet
+        self.flags = array("b")  # 1 compressed, 0 not, -1 removed
+        self.added = {}  # hash id -> (stored size or None, compressed)
+        self.removed = 0
+        self.lock = threading.Lock()
+        for key, size, compressed in sorted(blobs):
+            self.hashes.append(key)
+            self.sizes.append(-1 if size is None else size)
+            self.flags.append(int(compressed))
+
+    def find(self, key: int) -> int:
+        """position of the hash in the sorted arrays, -1 if it is not there or removed"""
+        i = bisect_left(self.hashes, key)
+        if i < len(self.hashes) and self.hashes[i] == key and self.flags[i] >= 0:
+            return i
+        return -1
+
+    def get(self, hash: str, default=None) -> Optional[tuple]:
+        key = hash_id(hash)
+        with self.lock:
+            entry = self.added.get(key)
+            if entry is not None:
+                return entry
+            i = self.find(key)
+            if i < 0:
+                return default
+            return (self.sizes[i] if self.sizes[i] >= 0 else None), bool(self.flags[i])
+
+    def __contains__(self, hash: str) -> bool:
+        return self.get(hash) is not None
+
+    def __setitem__(self, hash: str, entry: tuple):
+        key = hash_id(hash)
+        size, compressed = entry
+        with self.lock:
+            i = self.find(key)
+            if i >= 0:
+                self.sizes[i] = -1 if size is None else size
+                self.flags[i] = int(compressed)
+                return
+            self.added[key] = (size, compressed)
+            if len(self.added) >= max(BLOB_INDEX_MERGE_MIN, len(self.hashes) // 8):
+                self.merge()
+
+    def pop(self, hash: str, default=None) -> Optional[tuple]:
+        key = hash_id(hash)
+        with self.lock:
+            entry = self.added.pop(key, None)
+            if entry is not None:
+                return entry
+            i = self.find(key)
+            if i < 0:
+                return default
+            entry = (self.sizes[i] if self.sizes[i] >= 0 else None), bool(self.flags[i])
+            self.flags[i] = -1
+            self.removed += 1
+            if self.removed >= max(BLOB_INDEX_MERGE_MIN, len(self.hashes) // 8):
+                self.merge()
+            return entry
+
+    def __len__(self) -> int:
+        return len(self.hashes) - self.removed + len(self.added)
+
+    def merge(self):
+        """put the added blobs into the sorted arrays and drop the removed ones, the lock must be held"""
+        live = (
+            (key, size, flag) for key, size, flag in zip(self.hashes, self.sizes, self.flags) if flag >= 0
+        )
+        added = sorted(
+            (key, -1 if size is None else size, int(compressed)) for key, (size, compressed) in self.added.items()
+        )
+        hashes, sizes, flags = array("q"), array("q"), array("b")
+        for key, size, flag in heapq.merge(live, added):
+            hashes.append(key)
+            sizes.append(size)
+            flags.append(flag)
+        self.hashes, self.sizes, self.flags = hashes, sizes, flags
+        self.added = {}
+        self.removed = 0
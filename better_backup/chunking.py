@@ -0,0 +1,58 @@
+import functools
+from typing import List, Optional, Tuple
+
+from pyfastcdc import FastCDC
+
+REGION_SECTOR_SIZE = 4096
+REGION_HEADER_SIZE = 2 * REGION_SECTOR_SIZE  # location table + timestamp table
+REGION_EXTS = (".mca", ".mcr")
+
+
+def split_region(data: memoryview) -> Optional[List[Tuple[int, int]]]:
+    """
+    split an anvil region file into (start, end) ranges: the header, every chunk
+    with its sector padding, and the free sectors between them.
+    the ranges cover the whole file in order so joining them gives the same bytes,
+    returns None if the location table does not describe the file
+    """
+    size = len(data)
+    if size < REGION_HEADER_SIZE:
+        return None
+    sectors = []
+    for i in range(0, REGION_SECTOR_SIZE, 4):
+        offset = int.from_bytes(data[i:i + 3], "big")
+        count = data[i + 3]
+        if offset == 0 and count == 0:  # chunk not generated
+            continue
+        start = offset * REGION_SECTOR_SIZE
+        end = start + count * REGION_SECTOR_SIZE
+        if start < REGION_HEADER_SIZE or count == 0 or end > size:
+            return None
+        sectors.append((start, end))
+    sectors.sort()
+
+    ranges = [(0, REGION_HEADER_SIZE)]
+    pos = REGION_HEADER_SIZE
+    for start, end in sectors:
+        if start < pos:  # overlapping chunks
+            return None
+        if start > pos:
+            ranges.append((pos, start))
+        ranges.append((start, end))
+        pos = end
+    if pos < size:
+        ranges.append((pos, size))
+    return ranges
+
+
+@functools.lru_cache()
+def get_fastcdc(avg_size: int) -> FastCDC:
+    return FastCDC(avg_size)
+
+
+def split_cdc(data: memoryview, avg_size: int = 65536) -> List[Tuple[int, int]]:
+    """content-defined chunking, boundaries follow the content so an insert only changes nearby chunks"""
+    return [
+        (chunk.offset, chunk.offset + chunk.length)
+        for chunk in get_fastcdc(avg_size).cut_buf(data)
+    ]
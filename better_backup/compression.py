@@ -0,0 +1,50 @@
+import os
+from typing import Dict, Optional
+
+from pyzstd import CParameter, DParameter, get_frame_info
+
+# frames written with a large window_log can only be read with a matching limit
+DECOMPRESS_OPTION = {DParameter.windowLogMax: 31}
+
+# small files sharing a structure, each class gets its own dictionary
+DICT_CLASSES = {  # file class -> (parent folder, extension)
+    "playerdata": ("playerdata", ".dat"),
+    "stats": ("stats", ".json"),
+    "advancements": ("advancements", ".json"),
+    "data": ("data", ".dat"),
+}
+
+
+def get_compress_option(
+    level: int,
+    threads: int = 0,
+    long_distance: bool = False,
+    window_log: int = 0,
+) -> Dict[int, int]:
+    """
+    zstd parameters for pyzstd's level_or_option.
+    threads > 0 compresses a single stream with that many workers, window_log 0 keeps the level's default
+    """
+    option = {CParameter.compressionLevel: level}
+    if threads > 0:
+        option[CParameter.nbWorkers] = threads
+    if long_distance:
+        option[CParameter.enableLongDistanceMatching] = 1
+    if window_log:
+        option[CParameter.windowLog] = window_log
+    return option
+
+
+def get_file_class(path: str, name: str) -> Optional[str]:
+    """dictionary class of a world file, None if it has none"""
+    folder = os.path.basename(os.path.normpath(path))
+    extension = os.path.splitext(name)[1]
+    for file_class, class_key in DICT_CLASSES.items():
+        if class_key == (folder, extension):
+            return file_class
+    return None
+
+
+def get_frame_dict_id(header: bytes) -> Optional[int]:
+    """dictionary id in a zstd frame header (its first 18 bytes are enough), None if it has none"""
+    return get_frame_info(header).dictionary_id or None
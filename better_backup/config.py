@@ -31,11 +31,33 @@ class Configuration(Serializable):
         "Saved the game",  # 1.13+
         "Saved the world",  # 1.12-
     ]
+    save_timeout: float = 60.0  # seconds to wait for saved_output, 0 to wait forever
+    save_timeout_action: str = "continue"  # continue / abort, when the game is not reported saved in time
 
     backup_data_path: str = "./better_backup"
     server_path: str = "./server"
     overwrite_backup_folder: str = "overwrite"
+    incremental_restore: bool = True  # only rewrite files that differ from the backup
+    restore_workers: int = 0  # decompress workers, 0 for one per cpu
     backup_compress_level: int = 3  # 0 to disable
+    zstd_threads: int = 0  # compress each large blob and tar_zst export with this many threads, 0 for one
+    zstd_long_distance: bool = False  # long distance matching, finds repeats far apart in large files
+    zstd_window_log: int = 0  # 10 ~ 31, 0 for the level's default, larger windows use more memory
+    dict_compression: bool = True  # train a zstd dictionary for each kind of small file, e.g. playerdata
+    dict_size: int = 65536  # bytes
+    blob_store: str = "file"  # file / pack, pack appends small blobs to large pack files instead of a file each
+    pack_blob_size: int = 1048576  # bytes, larger files are always stored on their own
+    pack_size: int = 268435456  # bytes, a new pack file is started after this size
+    snapshot_backup: bool = False  # copy changed files aside and turn auto save on before hashing them
+    paranoid_backup: bool = False  # re-hash every file even if its stat is unchanged
+    backup_workers: int = 2  # hash and compress workers, 0 for one per cpu
+    backup_worker_type: str = "thread"  # thread / process
+    region_dedup: bool = True  # store region files chunk by chunk
+    chunking_threshold: int = 16777216  # bytes, larger files are stored in content-defined chunks, 0 to disable
+    chunking_avg_size: int = 65536  # bytes, 256 ~ 4194304
+    manifest_checkpoint_interval: int = 20  # one backup in this many lists all its files, the rest only what changed
+    verify_workers: int = 2  # read and hash workers of verify, 0 for one per cpu
+    verify_rate_limit: float = 50.0  # MB/s verify reads at most, 0 for no limit
 
     export_backup_folder: str = "./export_backup"
     export_backup_format: str = "tar_gz"  # plain / tar / tar_gz / tar_xz
@@ -53,13 +75,22 @@ class Configuration(Serializable):
         "abort": 1,
         "reload": 2,
         "list": 0,
+        "stats": 0,
         "reset": 2,
+        "gc": 2,
+        "train": 2,
+        "repack": 2,
+        "verify": 2,
         "timer": 2,
         "export": 4,
     }
 
     timer_enabled: bool = True
-    timer_interval: float = 5.0  # minutes
+    timer_interval: float = 5.0  # minutes, 0 to only use timer_cron
+    timer_cron: List[str] = []  # cron expressions in local time, e.g. "0 4 * * *" for 4 am every day
+    timer_require_players: bool = False  # interval backups only run if a player has been online since the last backup
+    timer_quiet_hours: List[str] = []  # e.g. "01:00-07:00", timed backups are put off until the end
+    timer_unchanged: str = "skip"  # skip / alias / backup, when the world is the same as the latest backup
 
     def save(self):
         server_inst.save_config_simple(self, CONFIG_FILE, in_data_folder=False)
@@ -6,11 +6,26 @@ PREFIX = "!!bb"
 OLD_METADATA_DIR = "metadata"
 
 CACHE_DIR = "cache"
+DICT_DIR = "dicts"
+PACK_DIR = "packs"
 TEMP_DIR = "override"
+STAGE_DIR = "staging"
 
 LIST_PAGE_SIZE = 10
 
 ZST_EXT = ".zst"
 
+PROGRESS_INTERVAL = 5  # seconds
+TIMER_MAX_SLEEP = 60  # seconds, the timer checks the clock again after this even if nothing is due
+TIMER_STATE_FILE = "timer.json"
+VERIFY_STATE_FILE = "verify.json"  # where an interrupted verify goes on from
+RESTORE_READ_SIZE = 1024 * 1024
+CACHE_READ_SIZE = 1024 * 1024
+ZSTD_THREADS_MIN_SIZE = 8 * 1024 * 1024  # smaller blobs are not worth starting zstd threads for
+DICT_MAX_FILE_SIZE = 128 * 1024  # larger files compress well enough without a dictionary
+DICT_MIN_SAMPLES = 32
+FICLONE = 0x40049409  # linux ioctl to reflink a file
+REPACK_GARBAGE_RATIO = 0.25  # packs with more removed bytes than this are rewritten by repack
+
 # this is an official api now btw
 server_inst = ServerInterface.get_instance().as_plugin_server_interface()
@@ -1,31 +1,264 @@
+from typing import List, Optional
 from pydal import DAL, Field
 import os
 from better_backup.config import config
 
 database: DAL = None
 
+SCHEMA_VERSION = 6
+
+
+def hash_id(hash: Optional[str]) -> Optional[int]:
+    """xxh3_64 hex digest as the signed 64 bit integer sqlite stores, hash_id() in sql"""
+    if hash is None:
+        return None
+    value = int(hash, 16)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def set_pragmas(adapter):
+    """run on every new connection, pydal keeps one per thread"""
+    adapter.execute("PRAGMA synchronous=NORMAL;")  # safe with WAL
+    adapter.execute("PRAGMA temp_store=MEMORY;")
+    adapter.execute("PRAGMA cache_size=-32768;")  # 32 MiB
+    adapter.connection.create_function("hash_id", 1, hash_id, deterministic=True)
+
 
 def load_database():
     global database
     os.makedirs(config.backup_data_path, exist_ok=True)
-    database = DAL("sqlite://storage.db", folder=config.backup_data_path, auto_import=True)
-
-    if 'files' not in database.tables:
-      database.define_table("files",
-                            Field("backup_uuid"),
-                            Field("name"),
-                            Field("hash"),
-                            Field("hash_type"),
-                            Field("path")
-                          )
-    if 'backups' not in database.tables:
-      database.define_table("backups", 
-                            Field("uuid"), 
-                            Field("time", type="integer"), 
-                            Field("size", type="integer"), 
-                            Field("message"), 
-                            Field("locked", type="boolean", default=False)
-                          )
+    # tables are always defined so that pydal adds new columns to old storage.db
+    database = DAL("sqlite://storage.db", folder=config.backup_data_path, after_connection=set_pragmas)
+    database.executesql("PRAGMA journal_mode=WAL;")
+
+    database.define_table("paths",  # every path and name a world file has had, stored once
+                          Field("path"),
+                          Field("name")
+                        )
+    database.define_table("manifest",  # the files of each backup, or only what changed since its parent
+                          Field("backup_id", type="integer"),  # id in backups table
+                          Field("path_id", type="integer"),
+                          Field("hash", type="bigint"),  # see hash_id, None for a file removed since the parent
+                          Field("size", type="bigint"),  # uncompressed, None for backups of old versions
+                          Field("dict_id", type="integer")  # zstd dictionary of the blob, None for no dictionary
+                        )
+    database.define_table("files",  # replaced by manifest and paths in version 5, only read by migrate
+                          Field("backup_uuid"),
+                          Field("name"),
+                          Field("hash"),
+                          Field("hash_type"),
+                          Field("path"),
+                          Field("size", type="bigint"),
+                          Field("dict_id", type="integer"),
+                          migrate=False
+                        )
+    database.define_table("backups",
+                          Field("uuid"),
+                          Field("time", type="integer"),
+                          Field("size", type="integer"),
+                          Field("message"),
+                          Field("locked", type="boolean", default=False),
+                          Field("parent_id", type="integer"),  # manifest is a delta of this backup, None for a full one
+                          Field("logical_size", type="bigint"),  # uncompressed bytes of its files
+                          Field("stored_size", type="bigint"),  # bytes of the distinct blobs it uses
+                          Field("new_size", type="bigint"),  # bytes of the blobs it added to the cache
+                          Field("unique_size", type="bigint")  # bytes of the blobs no other backup uses
+                        )
+    database.define_table("fingerprints",  # stat of the last cached file at each path
+                          Field("path"),
+                          Field("size", type="bigint"),
+                          Field("mtime_ns", type="bigint"),
+                          Field("inode", type="bigint"),
+                          Field("hash")
+                        )
+    database.define_table("chunks",  # pieces of files that are not cached as a whole
+                          Field("hash"),
+                          Field("seq", type="integer"),
+                          Field("chunk_hash"),
+                          Field("size", type="bigint")
+                        )
+    database.define_table("dictionaries",  # trained zstd dictionaries, stored in dicts/<dict_id>.zdict
+                          Field("dict_id", type="integer"),
+                          Field("file_class"),
+                          Field("version", type="integer"),
+                          Field("time", type="integer")
+                        )
+    database.define_table("packed",  # blobs stored in pack files instead of the cache folder
+                          Field("hash"),
+                          Field("pack", type="integer"),
+                          Field("start", type="bigint"),
+                          Field("length", type="bigint"),
+                          Field("compressed", type="integer")
+                        )
+    database.define_table("blobs",  # every stored blob with the number of backups using it
+                          Field("hash"),
+                          Field("size", type="bigint"),
+                          Field("refs", type="integer")
+                        )
+    database.define_table("stats",  # totals kept up to date by create, remove and gc
+                          Field("name"),
+                          Field("value", type="bigint")
+                        )
+    migrate_database()
+
+
+def migrate_database():
+    """upgrade storage.db created by older versions, tracked by user_version"""
+    version = database.executesql("PRAGMA user_version;")[0][0]
+    files_table = is_table("files")
+    if version < 1:
+        for index, table, column in [
+            *([("files_backup_uuid", "files", "backup_uuid"), ("files_hash", "files", "hash")] if files_table else []),
+            ("backups_uuid", "backups", "uuid"),
+            ("fingerprints_path", "fingerprints", "path"),
+            ("chunks_hash", "chunks", "hash"),
+            ("chunks_chunk_hash", "chunks", "chunk_hash"),
+        ]:
+            database.executesql(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({column});')
+    if version < 2:
+        database.executesql('CREATE INDEX IF NOT EXISTS packed_hash ON packed (hash);')
+        database.executesql('CREATE INDEX IF NOT EXISTS packed_pack ON packed (pack);')
+    if version < 3:  # the tables are filled by rebuild_stats_util
+        database.executesql('CREATE UNIQUE INDEX IF NOT EXISTS blobs_hash ON blobs (hash);')
+        database.executesql('CREATE UNIQUE INDEX IF NOT EXISTS stats_name ON stats (name);')
+    if version < 4:
+        database.executesql('CREATE INDEX IF NOT EXISTS backups_time ON backups (time);')
+        database.executesql(  # kept up to date from now on
+            "INSERT OR REPLACE INTO stats (name, value) SELECT 'backup_count', COUNT(*) FROM backups;"
+        )
+    if version < 5:
+        if files_table and database.executesql("SELECT 1 FROM files WHERE hash_type = 'md5' LIMIT 1;"):
+            return  # on_load refuses md5 backups of the first versions, leave them as they are
+        database.executesql('CREATE UNIQUE INDEX IF NOT EXISTS paths_path_name ON paths (path, name);')
+        database.executesql('CREATE INDEX IF NOT EXISTS manifest_backup_id ON manifest (backup_id);')
+        database.executesql('CREATE INDEX IF NOT EXISTS manifest_hash ON manifest (hash);')
+        if files_table:  # rows of removed backups are dropped on the way
+            columns = {row[1] for row in database.executesql("PRAGMA table_info(files);")}
+            size, dict_id = (f"files.{column}" if column in columns else "NULL" for column in ("size", "dict_id"))
+            database.executesql("INSERT OR IGNORE INTO paths (path, name) SELECT DISTINCT path, name FROM files;")
+            database.executesql(
+                "INSERT INTO manifest (backup_id, path_id, hash, size, dict_id) "
+                f"SELECT backups.id, paths.id, hash_id(files.hash), {size}, {dict_id} FROM files "
+                "JOIN backups ON backups.uuid = files.backup_uuid "
+                "JOIN paths ON paths.path = files.path AND paths.name = files.name "
+                "ORDER BY files.id;"
+            )
+            database.executesql("DROP TABLE files;")
+    if version < 6:
+        database.executesql("DROP VIEW IF EXISTS files;")  # created by version 5
+        database.executesql('CREATE INDEX IF NOT EXISTS manifest_backup_path ON manifest (backup_id, path_id);')
+        database.executesql('DROP INDEX IF EXISTS manifest_backup_id;')  # covered by manifest_backup_path
+        database.executesql('CREATE INDEX IF NOT EXISTS backups_parent_id ON backups (parent_id);')
+        # every backup had all its files, keep one in manifest_checkpoint_interval and turn the rest into deltas.
+        # newest first, so the parent of each is still full
+        backup_ids = [row[0] for row in database.executesql("SELECT id FROM backups ORDER BY time, id;")]
+        for index in range(len(backup_ids) - 1, 0, -1):
+            if index % max(config.manifest_checkpoint_interval, 1):
+                write_delta(backup_ids[index], backup_ids[index - 1])
+    if version < SCHEMA_VERSION:
+        database.executesql(f"PRAGMA user_version={SCHEMA_VERSION};")
+        database.commit()
+        if version < 6 and database.executesql("SELECT 1 FROM backups LIMIT 1;"):
+            database.executesql("VACUUM;")  # give the space of the old rows back
+
+
+def manifest_entries(backup_filter: str) -> str:
+    """
+    a WITH clause of table entries (backup_id, path_id, hash, size, dict_id), the files of the backups
+    matching backup_filter. a backup takes each path from the nearest of itself and its parents recording it
+    """
+    return (
+        "WITH RECURSIVE chain (backup_id, ancestor_id, depth) AS ("
+        f"SELECT id, id, 0 FROM backups WHERE {backup_filter} "
+        "UNION ALL SELECT chain.backup_id, backups.parent_id, chain.depth + 1 FROM chain "
+        "JOIN backups ON backups.id = chain.ancestor_id WHERE backups.parent_id IS NOT NULL"
+        "), entries (backup_id, path_id, hash, size, dict_id) AS ("
+        "SELECT backup_id, path_id, hash, size, dict_id FROM ("
+        # sqlite takes the bare columns from the row with the smallest depth
+        "SELECT chain.backup_id, manifest.path_id, manifest.hash, manifest.size, manifest.dict_id, MIN(chain.depth) "
+        "FROM chain JOIN manifest ON manifest.backup_id = chain.ancestor_id GROUP BY chain.backup_id, manifest.path_id"
+        ") WHERE hash IS NOT NULL) "
+    )
+
+
+def manifest_reach(hash_filter: str) -> str:
+    """
+    a WITH clause of table reach (backup_id, path_id, hash), the files matching hash_filter on manifest
+    and every backup having them, from the one recording it down to the children inheriting it
+    """
+    return (
+        "WITH RECURSIVE reach (backup_id, path_id, hash) AS ("
+        f"SELECT backup_id, path_id, hash FROM manifest WHERE {hash_filter} "
+        "UNION ALL SELECT backups.id, reach.path_id, reach.hash FROM reach "
+        "JOIN backups ON backups.parent_id = reach.backup_id WHERE NOT EXISTS ("
+        "SELECT 1 FROM manifest WHERE manifest.backup_id = backups.id AND manifest.path_id = reach.path_id)"
+        ") "
+    )
+
+
+def get_chain_length(backup_id: int) -> int:
+    """number of parents a backup has to be read with, 0 for a full one"""
+    return database.executesql(
+        "WITH RECURSIVE chain (id, depth) AS (SELECT ?, 0 UNION ALL SELECT backups.parent_id, chain.depth + 1 "
+        "FROM chain JOIN backups ON backups.id = chain.id WHERE backups.parent_id IS NOT NULL) "
+        "SELECT MAX(depth) FROM chain;",
+        placeholders=[backup_id],
+    )[0][0]
+
+
+def write_delta(backup_id: int, parent_id: Optional[int]):
+    """rewrite the manifest of a backup as the changes from parent_id, or in full if None. its files stay the same"""
+    for table, id in (("delta_new", backup_id), ("delta_base", parent_id)):
+        database.executesql(
+            f"CREATE TEMP TABLE IF NOT EXISTS {table} (path_id INTEGER PRIMARY KEY, hash INTEGER, size INTEGER, dict_id INTEGER);"
+        )
+        database.executesql(f"DELETE FROM {table};")
+        if id is not None:
+            database.executesql(
+                manifest_entries("id = ?") + f"INSERT INTO {table} SELECT path_id, hash, size, dict_id FROM entries;",
+                placeholders=[id],
+            )
+    database.executesql("DELETE FROM manifest WHERE backup_id = ?;", placeholders=[backup_id])
+    database.executesql(
+        "INSERT INTO manifest (backup_id, path_id, hash, size, dict_id) SELECT ?, path_id, hash, size, dict_id "
+        "FROM delta_new WHERE NOT EXISTS (SELECT 1 FROM delta_base WHERE delta_base.path_id = delta_new.path_id "
+        "AND delta_base.hash = delta_new.hash AND delta_base.size IS delta_new.size "
+        "AND delta_base.dict_id IS delta_new.dict_id) ORDER BY path_id;",
+        placeholders=[backup_id],
+    )
+    database.executesql(  # removed files
+        "INSERT INTO manifest (backup_id, path_id) SELECT ?, path_id FROM delta_base "
+        "WHERE path_id NOT IN (SELECT path_id FROM delta_new);",
+        placeholders=[backup_id],
+    )
+    database.executesql("UPDATE backups SET parent_id = ? WHERE id = ?;", placeholders=[parent_id, backup_id])
+
+
+def is_table(name: str) -> bool:
+    return bool(database.executesql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", placeholders=[name]))
+
+
+def bulk_insert(table: str, rows: List[dict]):
+    """one executemany in the current transaction, pydal's bulk_insert inserts row by row"""
+    if rows:
+        fields = list(rows[0])
+        database._adapter.connection.executemany(
+            'INSERT INTO "{}" ({}) VALUES ({});'.format(
+                table, ", ".join(f'"{field}"' for field in fields), ", ".join("?" * len(fields))
+            ),
+            [tuple(row[field] for field in fields) for row in rows],
+        )
+
+
+def bulk_update(table: str, fields: List[str], rows: List[tuple]):
+    """rows are the values of fields followed by the id"""
+    if rows:
+        database._adapter.connection.executemany(
+            'UPDATE "{}" SET {} WHERE id=?;'.format(
+                table, ", ".join(f'"{field}"=?' for field in fields)
+            ),
+            rows,
+        )
 
 
 load_database()
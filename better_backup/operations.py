@@ -1,4 +1,6 @@
+import functools
 import os
+import threading
 import time
 from math import ceil
 from shutil import rmtree
@@ -13,9 +15,11 @@ from better_backup.database import database, load_database
 from better_backup.timer import timer
 from better_backup.utils import *
 
-game_saved = False
+game_saved = threading.Event()  # set by on_info when the server prints one of saved_output
 selected_uuid = None
 restore_aborted = False
+verify_lock = threading.Lock()  # verify runs beside other operations, only one at a time
+verify_aborted = False
 
 
 def init_structure(data_dir: str):
@@ -31,30 +35,42 @@ def init_structure(data_dir: str):
 
 
 def trigger_abort(source: CommandSource):
-    global restore_aborted, selected_uuid
+    global restore_aborted, selected_uuid, verify_aborted
     restore_aborted = True
+    verify_aborted = True
     selected_uuid = None
     print_message(source, "Operation terminated!", reply_source=True)
 
 
 def game_save_triggered():
-    global game_saved
-    game_saved = True
+    game_saved.set()
+
+
+def wait_for_save(source: CommandSource) -> bool:
+    """save the game and wait for the server to report it, False if the backup should not go on"""
+    game_saved.clear()
+    save_start = time.time()
+    source.get_server().execute(config.save_command["save-all flush"])
+    if game_saved.wait(config.save_timeout if config.save_timeout > 0 else None):
+        print_message(source, tr("create_backup.saved", round(time.time() - save_start, 2)))
+        return True
+    if config.save_timeout_action == "abort":
+        print_message(source, tr("create_backup.abort.save_timeout", config.save_timeout))
+        return False
+    print_message(source, tr("create_backup.save_timeout", config.save_timeout))
+    return True
 
 
 def get_uuid(source: CommandSource, keyword: str = None):
     if keyword is None:  # get latest one
-        uuid = get_backups(orderby=~database.backups.time)[0].uuid
+        backup = get_backup_by_index(1)
     elif len(keyword) == 6:  # get by uuid
-        uuid = get_backup_row(keyword).uuid
-    else:  # get by index
-        try:
-            index = int(keyword)
-            if 0 < index <= config.backup_count_limit:
-                uuid = get_backups(orderby=~database.backups.time)[
-                    index - 1].uuid
-        except:
-            uuid = None
+        backup = get_backup_row(keyword)
+    elif keyword.isdigit():  # get by index, not limited to backup_count_limit as auto_remove may be off
+        backup = get_backup_by_index(int(keyword))
+    else:  # get by the start of uuid
+        backup = find_backup_by_prefix(keyword)
+    uuid = backup.uuid if backup is not None else None
     if not uuid:
         print_message(source, tr("unknown_backup"), reply_source=True)
     return uuid
@@ -66,29 +82,63 @@ def create_backup(source: CommandSource, message: Optional[str] = None):
 
 
 @single_op(tr("operations.create"))
-def do_create(source: CommandSource, message: Optional[str] = None):
-    global game_saved
-
+def do_create(source: CommandSource, message: Optional[str] = None, if_unchanged: str = "backup"):
+    """if_unchanged: skip / alias / backup, what to do when no world file changed since the latest backup"""
+    backup_info = None
     print_message(source, tr("create_backup.start"))
     start_time = time.time()
+    auto_save_off = config.turn_off_auto_save
+
+    def turn_on_auto_save():
+        nonlocal auto_save_off
+        if auto_save_off:  # ! reopen autosave
+            auto_save_off = False
+            source.get_server().execute(config.save_command["save-on"])
+            print_message(source, tr("create_backup.paused", round(time.time() - start_time, 1)))
 
     # start backup
-    game_saved = False
-    if config.turn_off_auto_save:
+    if auto_save_off:
         source.get_server().execute(config.save_command["save-off"])
-    source.get_server().execute(config.save_command["save-all flush"])
-    while True:
-        time.sleep(0.01)
-        if game_saved:
-            break
 
     try:
-        backup_info = create_backup_util(
-            *config.world_names,
-            message=message,
-            src_path=config.server_path,
-            config=config,
-        )
+        if not wait_for_save(source):
+            return
+        unchanged = None
+        if if_unchanged in ("skip", "alias"):
+            check_start = time.time()
+            unchanged = get_unchanged_backup_util(
+                *config.world_names, src_path=config.server_path, config=config
+            )
+        if unchanged is not None:
+            print_message(source, tr(
+                "create_backup.unchanged",
+                unchanged.uuid,
+                unchanged.file_count,
+                round((time.time() - check_start) * 1000),
+                format_dir_size(unchanged.logical_size),
+            ))
+            if if_unchanged == "skip":
+                timer.on_backup_skipped()
+                return
+            backup_info = alias_backup_util(unchanged.uuid, message)
+        else:
+            world = None
+            if config.snapshot_backup:  # hash and compress the staged copy with the game saving again
+                stage_start = time.time()
+                world, staged_count, staged_size = stage_world_util(
+                    *config.world_names, src_path=config.server_path, config=config
+                )
+                print_message(source, tr(
+                    "create_backup.staged", staged_count, format_dir_size(staged_size), round(time.time() - stage_start, 1)
+                ))
+                turn_on_auto_save()
+            backup_info = create_backup_util(
+                *config.world_names,
+                message=message,
+                src_path=config.server_path,
+                config=config,
+                world=world,
+            )
         print_message(
             source,
             tr(
@@ -100,6 +150,14 @@ def do_create(source: CommandSource, message: Optional[str] = None):
                 ),
             ),
         )
+        print_message(
+            source,
+            tr(
+                "create_backup.skipped",
+                backup_info.skipped_count,
+                backup_info.file_count,
+            ),
+        )
         timer.on_backup_created(backup_uuid=backup_info.uuid)
 
         # remove oldest backup if reached max count
@@ -118,8 +176,31 @@ def do_create(source: CommandSource, message: Optional[str] = None):
     except ModuleNotFoundError as e:
         print_message(source, tr("create_backup.fail", e))
     finally:
-        if config.turn_off_auto_save:  # ! reopen autosave
-            source.get_server().execute(config.save_command["save-on"])
+        turn_on_auto_save()
+        if config.snapshot_backup:
+            clear_stage()
+
+    # classes without a dictionary yet learn one from this backup, the game is saving again by now
+    if backup_info is not None and config.dict_compression and config.backup_compress_level:
+        print_trained_dicts(source, train_dicts_util(backup_info.uuid))
+
+
+def print_trained_dicts(source: CommandSource, trained: list, reply_source: bool = False):
+    for file_class, version, count in trained:
+        print_message(source, tr("train.success", file_class, version, count), reply_source=reply_source)
+
+
+@new_thread(thread_name("train"))
+@single_op(tr("operations.train"))
+def train_dicts(source: CommandSource, kw: Optional[str] = None):
+    uuid_result = get_uuid(source, kw)
+    if uuid_result is None:
+        return
+    print_message(source, tr("train.start", uuid_result), reply_source=True)
+    trained = train_dicts_util(uuid_result, retrain=True)
+    if not trained:
+        print_message(source, tr("train.not_enough_samples"), reply_source=True)
+    print_trained_dicts(source, trained, reply_source=True)
 
 
 @new_thread(thread_name("remove_backup"))
@@ -133,8 +214,10 @@ def remove_backup(
         return
 
     print_message(source, tr("remove_backup.start"))
+    freed = get_freed_size([uuid_result])
     remove_backup_util(backup_uuid=uuid_result)
     print_message(source, tr("remove_backup.success", uuid_result))
+    print_message(source, tr("remove_backup.freed", format_dir_size(freed)))
 
 
 def restore_backup(source: CommandSource, kw: Optional[str] = None):
@@ -201,6 +284,22 @@ def confirm_restore(source: CommandSource):
     do_restore(source)
 
 
+def print_restore_progress(source: CommandSource, done: int, total: int, written: int, elapsed: float):
+    elapsed = max(elapsed, 0.001)
+    print_message(
+        source,
+        tr(
+            "restore_backup.progress",
+            done,
+            total,
+            round(written / 2**20 / elapsed, 1),
+            round(done / elapsed),
+            round(elapsed * (total - done) / max(done, 1)),
+        ),
+        only_server=True,
+    )
+
+
 @single_op(tr("operations.restore"))
 def do_restore(source: CommandSource):
     global selected_uuid
@@ -209,20 +308,37 @@ def do_restore(source: CommandSource):
         server_inst.logger.info("Wait for server to stop")
         source.get_server().wait_for_start()
 
-        server_inst.logger.info("Backup current world to avoid idiot")
-        temp_and_clear(
-            *config.world_names,
-            temp_dir=os.path.join(
-                config.backup_data_path, config.overwrite_backup_folder
-            ),
-            src_path=config.server_path,
-        )
-        server_inst.logger.info(f"Restore backup §e{selected_uuid}§r")
+        if config.incremental_restore:
+            # files are replaced one by one, the replaced ones are kept in overwrite folder
+            server_inst.logger.info(f"Restore changed files of backup §e{selected_uuid}§r")
+            backup_info = restore_changed_util(
+                selected_uuid,
+                *config.world_names,
+                src_path=config.server_path,
+                temp_dir=os.path.join(
+                    config.backup_data_path, config.overwrite_backup_folder
+                ),
+                progress=functools.partial(print_restore_progress, source),
+            )
+            server_inst.logger.info(
+                f"{backup_info.restored_count} files restored, {backup_info.removed_count} files removed"
+            )
+        else:
+            server_inst.logger.info("Backup current world to avoid idiot")
+            temp_and_clear(
+                *config.world_names,
+                temp_dir=os.path.join(
+                    config.backup_data_path, config.overwrite_backup_folder
+                ),
+                src_path=config.server_path,
+            )
+            server_inst.logger.info(f"Restore backup §e{selected_uuid}§r")
 
-        backup_info = restore_backup_util(
-            backup_uuid=selected_uuid,
-            dst_dir=config.server_path,
-        )
+            backup_info = restore_backup_util(
+                backup_uuid=selected_uuid,
+                dst_dir=config.server_path,
+                progress=functools.partial(print_restore_progress, source),
+            )
         source.get_server().start()
         print_message(source, tr("restore_backup.success",
                       backup_info.uuid))
@@ -234,12 +350,13 @@ def do_restore(source: CommandSource):
                 source,
             )
         )
-        restore_temp(
-            config.world_names,
-            os.path.join(config.backup_data_path,
-                         config.overwrite_backup_folder),
-            config,
-        )
+        if not config.incremental_restore:  # incremental restore rolls back by itself
+            restore_temp(
+                *config.world_names,
+                temp_dir=os.path.join(config.backup_data_path,
+                                      config.overwrite_backup_folder),
+                src_path=config.server_path,
+            )
     finally:
         clear_temp(
             temp_dir=os.path.join(
@@ -265,46 +382,46 @@ def lock_backup(source: CommandSource, kw: Optional[str] = None):
 
 
 def list_backups(source: CommandSource, page_num: int = 1):
-    all_backup_info = get_backups(orderby=~database.backups.time)
-    if len(all_backup_info) == 0: # empty
+    backup_count = get_backup_count()
+    if backup_count == 0: # empty
         print_message(source, tr("no_one_backup"), reply_source=True, prefix="")
         return
     print_message(source, tr("list_backup.title"), reply_source=True, prefix="")
-    if LIST_PAGE_SIZE * (page_num - 1) >= len(all_backup_info) or page_num <= 0: # page not found
+    if LIST_PAGE_SIZE * (page_num - 1) >= backup_count or page_num <= 0: # page not found
         print_message(source, tr(
             "list_backup.page.page_not_found"), reply_source=True, prefix="")
         return
     # output
-    for _i in range(((page_num - 1) * LIST_PAGE_SIZE), page_num * LIST_PAGE_SIZE):
-        if _i <= (len(all_backup_info) - 1):
-            backup_info = all_backup_info[_i]
-            uuid_info = RText(
-                f'[§e{str((_i+1)).zfill(len(str(LIST_PAGE_SIZE)))}§r] [§e{backup_info.uuid}§r] '
-                )
-            action_bar = RTextList(
-                "[",
-                RText("⊄ ", color=RColor.red) if backup_info.locked else RText("⊂ ", color=RColor.green)
-                    .h(tr("list_backup.unlock_hint" if backup_info.locked else "list_backup.lock_hint", backup_info.uuid))
-                    .c(RAction.suggest_command, f'{PREFIX} lock {backup_info.uuid}'),
-                RText("▷ ", color=RColor.green)
-                    .h(tr("list_backup.restore_hint", backup_info.uuid))
-                    .c(RAction.suggest_command, f'{PREFIX} restore {backup_info.uuid}'),
-                RText("⨯", color=RColor.green)
-                    .h(tr("list_backup.remove_hint", backup_info.uuid))
-                    .c(RAction.suggest_command, f'{PREFIX} remove {backup_info.uuid}'), 
-                "] "
-            )
-            detail = RText(
-                f'{time.strftime(r"%y-%m-%d %H:%M", time.localtime(backup_info.time))} §l*§r {format_dir_size(backup_info.size).ljust(10)}§l*§r '
-                + (tr("empty_comment") if backup_info.message is None else backup_info.message)
+    page_start = (page_num - 1) * LIST_PAGE_SIZE
+    for _i, backup_info in enumerate(get_backup_page(page_start, LIST_PAGE_SIZE), page_start):
+        uuid_info = RText(
+            f'[§e{str((_i+1)).zfill(len(str(LIST_PAGE_SIZE)))}§r] [§e{backup_info.uuid}§r] '
             )
-            print_message(source, 
-                            RTextList(uuid_info, action_bar, detail) if source.is_player
-                            else RTextList(uuid_info, detail),
-                            prefix="", reply_source=True
-                        )
-        else:
-            break
+        action_bar = RTextList(
+            "[",
+            RText("⊄ ", color=RColor.red) if backup_info.locked else RText("⊂ ", color=RColor.green)
+                .h(tr("list_backup.unlock_hint" if backup_info.locked else "list_backup.lock_hint", backup_info.uuid))
+                .c(RAction.suggest_command, f'{PREFIX} lock {backup_info.uuid}'),
+            RText("▷ ", color=RColor.green)
+                .h(tr("list_backup.restore_hint", backup_info.uuid))
+                .c(RAction.suggest_command, f'{PREFIX} restore {backup_info.uuid}'),
+            RText("⨯", color=RColor.green)
+                .h(tr("list_backup.remove_hint", backup_info.uuid))
+                .c(RAction.suggest_command, f'{PREFIX} remove {backup_info.uuid}'), 
+            "] "
+        )
+        backup_info = Backup.from_row(backup_info)
+        detail = RText(
+            f'{time.strftime(r"%y-%m-%d %H:%M", time.localtime(backup_info.time))} §l*§r {format_backup_size(backup_info).ljust(10)}§l*§r '
+            + (tr("empty_comment") if backup_info.message is None else backup_info.message)
+        )
+        if backup_info.dedup_ratio is not None:
+            detail.h(get_size_detail(backup_info))
+        print_message(source, 
+                        RTextList(uuid_info, action_bar, detail) if source.is_player
+                        else RTextList(uuid_info, detail),
+                        prefix="", reply_source=True
+                    )
     footer = RTextList(
         RText("[<<] ", color=RColor.green)
         .h(tr("list_backup.page.previous_page"))
@@ -312,7 +429,7 @@ def list_backups(source: CommandSource, page_num: int = 1):
             RAction.run_command,
             f"{PREFIX} list {page_num-1}",
         ),
-        RText(f"{page_num}/{ceil(len(all_backup_info) / LIST_PAGE_SIZE)}"),
+        RText(f"{page_num}/{ceil(backup_count / LIST_PAGE_SIZE)}"),
         RText(" [>>]", color=RColor.green)
         .h(tr("list_backup.page.next_page"))
         .c(
@@ -321,8 +438,8 @@ def list_backups(source: CommandSource, page_num: int = 1):
         ),
         "\n",
         RText(tr("list_backup.page.total_info", 
-                    len(all_backup_info), 
-                    format_dir_size(get_dir_size(os.path.join(config.backup_data_path, CACHE_DIR)))
+                    backup_count,
+                    format_dir_size(get_stat("cache_size") or 0)
                 )
             )
     )
@@ -340,12 +457,157 @@ def reset_cache(source: CommandSource):
         pass
     except Exception as e:
         raise e
+    pack_reader.close()
+    forget_packed_blobs()
+    forget_cached_blobs()
     rmtree(config.backup_data_path)
     init_structure(config.backup_data_path)
     load_database()
     print_message(source, tr("reset_backup.success"))
 
 
+@new_thread(thread_name("gc"))
+@single_op(tr("operations.gc"))
+def gc_backup(source: CommandSource):
+    print_message(source, tr("gc.start"), reply_source=True)
+    count, freed = gc_util()
+    print_message(source, tr("gc.success", count, format_dir_size(freed)), reply_source=True)
+
+
+def print_verify_progress(source: CommandSource, done: int, total: int, read: int, elapsed: float):
+    print_message(
+        source,
+        tr("verify.progress", done, total, round(read / 2**20 / max(elapsed, 0.001), 1)),
+        only_server=True,
+    )
+
+
+@new_thread(thread_name("verify"))
+def verify_backup(source: CommandSource, kw: Optional[str] = None):
+    """not a single_op, so that timed backups still run during a long scrub"""
+    global verify_aborted
+    if not verify_lock.acquire(blocking=False):
+        print_message(source, tr("lock.warning", tr("operations.verify")), reply_source=True)
+        return
+    try:
+        uuid_result = None
+        if kw is not None and kw != "all":
+            uuid_result = get_uuid(source, kw)
+            if uuid_result is None:
+                return
+        verify_aborted = False
+        print_message(
+            source,
+            tr(
+                "verify.start",
+                tr("verify.backup", uuid_result) if uuid_result is not None else tr("verify.all"),
+                f"{config.verify_rate_limit} MB/s" if config.verify_rate_limit > 0 else tr("verify.no_limit"),
+            ),
+            reply_source=True,
+        )
+        result = verify_util(
+            uuid_result,
+            progress=lambda *args: print_verify_progress(source, *args),
+            aborted=lambda: verify_aborted,
+        )
+        if result is None:
+            print_message(source, tr("verify.aborted", PREFIX), reply_source=True)
+            return
+        total, corrupt, uuids, mismatched = result
+        if not corrupt:
+            print_message(source, tr("verify.success", total), reply_source=True)
+        else:
+            print_message(
+                source,
+                tr("verify.corrupt", total, len(corrupt), ", ".join(corrupt[:10]) + (" ..." if len(corrupt) > 10 else "")),
+                reply_source=True,
+            )
+            print_message(source, tr("verify.affected", ", ".join(uuids) or "-"), reply_source=True)
+        if mismatched:
+            print_message(
+                source,
+                tr(
+                    "verify.dict_mismatch",
+                    len(mismatched), ", ".join(mismatched[:10]) + (" ..." if len(mismatched) > 10 else ""),
+                ),
+                reply_source=True,
+            )
+    finally:
+        verify_lock.release()
+
+
+def format_backup_size(backup_info: Backup) -> str:
+    """bytes the backup added, the total for backups of older versions"""
+    if backup_info.new_size is None:
+        return format_dir_size(backup_info.size)
+    return "+" + format_dir_size(backup_info.new_size)
+
+
+def get_size_detail(backup_info: Backup) -> RTextBase:
+    return tr(
+        "list_backup.size_detail",
+        format_dir_size(backup_info.logical_size),
+        format_dir_size(backup_info.stored_size),
+        format_dir_size(backup_info.new_size),
+        round(backup_info.dedup_ratio, 2),
+        format_dir_size(backup_info.unique_size),
+    )
+
+
+def show_stats(source: CommandSource, kw: Optional[str] = None):
+    print_message(source, tr("stats.title"), reply_source=True, prefix="")
+    if kw is not None:
+        uuid_result = get_uuid(source, kw)
+        if uuid_result is None:
+            return
+        backup_info = Backup.from_row(get_backup_row(uuid_result))
+        if backup_info.dedup_ratio is None:
+            print_message(source, tr("stats.not_ready"), reply_source=True, prefix="")
+            return
+        print_message(
+            source,
+            tr(
+                "stats.backup",
+                uuid_result,
+                format_dir_size(backup_info.stored_size),
+                format_dir_size(backup_info.unique_size),
+                format_dir_size(backup_info.stored_size - backup_info.unique_size),
+            ),
+            reply_source=True,
+            prefix="",
+        )
+        print_message(source, get_size_detail(backup_info), reply_source=True, prefix="")
+        return
+    print_message(
+        source,
+        tr(
+            "stats.total",
+            get_backup_count(),
+            get_stat("blob_count") or 0,
+            format_dir_size(get_stat("cache_size") or 0),
+        ),
+        reply_source=True,
+        prefix="",
+    )
+
+
+@new_thread(thread_name("stats"))
+@single_op(tr("operations.stats"))
+def rebuild_stats(source: CommandSource):
+    """count the storage of data from older versions, which kept no statistics"""
+    print_message(source, tr("stats.rebuild_start"), only_server=True)
+    rebuild_stats_util()
+    print_message(source, tr("stats.rebuild_success"), only_server=True)
+
+
+@new_thread(thread_name("repack"))
+@single_op(tr("operations.repack"))
+def repack_backup(source: CommandSource):
+    print_message(source, tr("repack.start"), reply_source=True)
+    count, freed = repack_util()
+    print_message(source, tr("repack.success", count, format_dir_size(freed)), reply_source=True)
+
+
 @new_thread(thread_name("export_backup"))
 @single_op(tr("operations.export"))
 def export_backup(
@@ -0,0 +1,87 @@
+import mmap
+import os
+import threading
+from typing import Dict, Tuple
+
+PACK_EXT = ".pack"
+
+
+def get_pack_file(pack_dir: str, pack: int) -> str:
+    return os.path.join(pack_dir, f"{pack:06d}{PACK_EXT}")
+
+
+def list_packs(pack_dir: str) -> Dict[int, int]:
+    """pack number -> file size"""
+    packs = {}
+    if os.path.isdir(pack_dir):
+        for name in os.listdir(pack_dir):
+            number = name[:-len(PACK_EXT)]
+            if name.endswith(PACK_EXT) and number.isdigit():
+                packs[int(number)] = os.path.getsize(os.path.join(pack_dir, name))
+    return packs
+
+
+class PackWriter:
+    """
+    appends blobs to pack files, written bytes are never changed.
+    space of removed blobs is only given back when repack copies the rest to a new pack
+    """
+
+    def __init__(self, pack_dir: str, max_size: int, new_pack: bool = False):
+        self.pack_dir = pack_dir
+        self.max_size = max_size
+        self.new_pack = new_pack
+        self.pack = None
+        self.file = None
+
+    def append(self, data: bytes) -> Tuple[int, int]:
+        """returns (pack, offset) of the data"""
+        if self.file is not None and self.file.tell() >= self.max_size:
+            self.close()
+            self.new_pack = True
+        if self.file is None:
+            self.open()
+        offset = self.file.tell()
+        self.file.write(data)
+        return self.pack, offset
+
+    def open(self):
+        os.makedirs(self.pack_dir, exist_ok=True)
+        packs = list_packs(self.pack_dir)
+        self.pack = max(packs, default=0)
+        if self.new_pack or not packs or packs[self.pack] >= self.max_size:
+            self.pack += 1
+        self.file = open(get_pack_file(self.pack_dir, self.pack), "ab")  # positioned at the end
+
+    def close(self):
+        """the database may only refer to appended blobs after this"""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+class PackReader:
+    """reads blobs through a memory map of each pack, the maps are shared by threads"""
+
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.lock = threading.Lock()
+
+    def read(self, pack: int, offset: int, length: int) -> bytes:
+        with self.lock:
+            data = self.maps.get(pack)
+            if data is None or offset + length > len(data):  # appended since it was mapped
+                # a replaced map is closed once no other thread uses it
+                with open(get_pack_file(self.pack_dir, pack), "rb") as fpack:
+                    data = self.maps[pack] = mmap.mmap(fpack.fileno(), 0, access=mmap.ACCESS_READ)
+        return data[offset:offset + length]
+
+    def close(self):
+        """unmap every pack, must not be called while reading"""
+        with self.lock:
+            for data in self.maps.values():
+                data.close()
+            self.maps.clear()
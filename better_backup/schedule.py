@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+# (lowest, highest) of minute, hour, day of month, month, day of week (0 is sunday, so is 7)
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_SEARCH_YEARS = 5  # "0 0 29 2 1" may not come for a few years
+
+
+def parse_cron_field(field: str, low: int, high: int) -> set:
+    """"*", "5", "1-5", "*/15", "0-30/10" and lists of them like "0,30" """
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step <= 0:
+                raise ValueError(f"bad step in {field}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"{field} is out of {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """a standard five field cron expression in local time: minute hour day month weekday"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"{expression} does not have 5 fields")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            parse_cron_field(field, *field_range) for field, field_range in zip(fields, CRON_RANGES)
+        )
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        # like cron, a day matches either field if both are restricted
+        self.match_either_day = fields[2] != "*" and fields[4] != "*"
+
+    def match_day(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        return (day or weekday) if self.match_either_day else (day and weekday)
+
+    def next_time(self, after: float) -> float:
+        """the first matching minute later than after"""
+        moment = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment.replace(year=moment.year + CRON_SEARCH_YEARS, day=1)
+        while moment < limit:  # skip a whole month, day or hour when it does not match
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"{self.expression} never matches")
+
+
+def parse_quiet_hours(value: str) -> Tuple[int, int]:
+    """ "23:30-07:00" -> minutes of the day it starts and ends at, it may wrap past midnight"""
+    start, end = (datetime.strptime(clock.strip(), "%H:%M") for clock in value.split("-", 1))
+    return start.hour * 60 + start.minute, end.hour * 60 + end.minute
+
+
+def quiet_until(moment: float, quiet_hours: List[Tuple[int, int]]) -> Optional[float]:
+    """when the quiet hours around moment end, None if moment is not in any"""
+    local = datetime.fromtimestamp(moment)
+    minute = local.hour * 60 + local.minute
+    for start, end in quiet_hours:
+        if start <= end:
+            quiet = start <= minute < end
+        else:
+            quiet = minute >= start or minute < end
+        if quiet:
+            end_day = local if end > minute else local + timedelta(days=1)
+            return end_day.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0).timestamp()
+    return None
+
+
+def skip_quiet_hours(moment: float, quiet_hours: List[Tuple[int, int]]) -> float:
+    """the first time from moment that is not in quiet hours"""
+    for _ in range(len(quiet_hours) + 1):  # windows may end inside one another
+        end = quiet_until(moment, quiet_hours)
+        if end is None:
+            break
+        moment = end
+    return moment
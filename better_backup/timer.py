@@ -1,10 +1,13 @@
+import json
+import threading
 import time
 
 from mcdreforged.api.all import *
 
 import better_backup.operations
 from better_backup.config import config
-from better_backup.constants import server_inst
+from better_backup.constants import TIMER_MAX_SLEEP, TIMER_STATE_FILE, server_inst
+from better_backup.schedule import CronSchedule, parse_quiet_hours, skip_quiet_hours
 from better_backup.utils import *
 
 
@@ -16,6 +19,25 @@ class Timer():
         self.server = server
         self.is_enabled = config.timer_enabled
         self.is_backup_triggered = False
+        self.is_backup_skipped = False  # the world was unchanged, no backup was made
+        self.wakeup = threading.Event()  # set to work out the next backup time again
+        self.online_players = set()
+        self.players_active = False  # a player has been online since the last backup
+        self.cron_schedules = []
+        for expression in config.timer_cron:
+            try:
+                schedule = CronSchedule(expression)
+                schedule.next_time(time.time())  # "0 0 30 2 *" parses but never comes
+                self.cron_schedules.append(schedule)
+            except ValueError as e:
+                server.logger.warning(Timer.tr("invalid_schedule", expression, e))
+        self.quiet_hours = []
+        for value in config.timer_quiet_hours:
+            try:
+                self.quiet_hours.append(parse_quiet_hours(value))
+            except ValueError as e:
+                server.logger.warning(Timer.tr("invalid_schedule", value, e))
+        self.load_state()
 
     @staticmethod
     def get_interval() -> float:
@@ -31,6 +53,34 @@ class Timer():
             "better_backup.timer.{}".format(translation_key), *args
         )
 
+    @staticmethod
+    def get_state_file() -> str:
+        return os.path.join(config.backup_data_path, TIMER_STATE_FILE)
+
+    def load_state(self):
+        """continue from where the last plugin instance stopped, so a reload does not delay the next backup"""
+        try:
+            with open(self.get_state_file(), "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.time_since_backup = state["time_since_backup"]
+            self.online_players = set(state["online_players"])
+            self.players_active = state["players_active"]
+        except (OSError, ValueError, KeyError):
+            latest = get_backup_by_index(1)
+            if latest is not None:
+                self.time_since_backup = latest.time
+
+    def save_state(self):
+        with open(self.get_state_file(), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "time_since_backup": self.time_since_backup,
+                    "online_players": sorted(self.online_players),
+                    "players_active": self.players_active,
+                },
+                f,
+            )
+
     def _set_interval(self, timer_interval: float):
         self.timer_interval = timer_interval
         config.timer_interval = timer_interval
@@ -55,19 +105,40 @@ class Timer():
 
     def _reset(self):
         self.time_since_backup = time.time()
+        self.players_active = len(self.online_players) > 0
+        self.save_state()
+        self.wakeup.set()
 
     def reset(self, source: CommandSource):
         self._reset()
         source.reply(Timer.tr("reset_timer"))
         self.broadcast_next_backup_time()
 
+    def get_interval_time(self) -> Optional[float]:
+        if self.get_interval() <= 0:
+            return None
+        return self.time_since_backup + self.get_backup_interval()
+
+    def get_cron_time(self) -> Optional[float]:
+        return min((schedule.next_time(self.time_since_backup) for schedule in self.cron_schedules), default=None)
+
+    def get_next_backup_time(self) -> Optional[float]:
+        """None if there is no schedule"""
+        next_time = min(filter(None, (self.get_interval_time(), self.get_cron_time())), default=None)
+        if next_time is None:
+            return None
+        # a backup overdue since the server was down still waits for the quiet hours of now to end
+        return skip_quiet_hours(max(next_time, time.time()), self.quiet_hours)
+
     def get_next_backup_message(self):
+        next_time = self.get_next_backup_time()
+        if next_time is None:
+            return self.tr("no_schedule")
         return self.tr(
             "get_next_backup_message",
             time.strftime(
                 "%Y/%m/%d %H:%M:%S",
-                time.localtime(self.time_since_backup +
-                               self.get_backup_interval()),
+                time.localtime(next_time),
             ),
         )
 
@@ -80,33 +151,73 @@ class Timer():
         self.broadcast_next_backup_time()
         self.is_backup_triggered = True
 
+    def on_backup_skipped(self):
+        self._reset()
+        self.is_backup_skipped = True
+
+    def on_player_joined(self, player: str):
+        self.online_players.add(player)
+        self.players_active = True
+        self.save_state()
+
+    def on_player_left(self, player: str):
+        self.online_players.discard(player)
+        self.save_state()
+
+    def on_server_startup(self):
+        self.online_players.clear()
+        self.save_state()
+        self.wakeup.set()
+
+    def trigger(self):
+        now = time.time()
+        cron_time = self.get_cron_time()
+        if cron_time is not None and cron_time <= now:
+            self.broadcast(self.tr("run.trigger_cron", " §l|§r ".join(
+                schedule.expression for schedule in self.cron_schedules if schedule.next_time(self.time_since_backup) <= now
+            )))
+        elif config.timer_require_players and not self.players_active:  # due to the interval only
+            self.broadcast(self.tr("run.no_player"))
+            self._reset()
+            self.broadcast_next_backup_time()
+            return
+        else:
+            self.broadcast(self.tr("run.trigger_time", self.get_interval()))
+        self.is_backup_triggered = False
+        self.is_backup_skipped = False
+
+        better_backup.operations.do_create(
+            self.server.get_plugin_command_source(),
+            str(self.tr("run.timed_backup", "timer")),
+            if_unchanged=config.timer_unchanged,
+        )
+
+        if self.is_backup_triggered:
+            self.broadcast(self.tr("on_backup_succeed"))
+        elif self.is_backup_skipped:
+            self.broadcast(self.tr("on_backup_skipped"))
+            self.broadcast_next_backup_time()
+        else:
+            self.broadcast(self.tr("on_backup_failed"))
+            self._reset()
+            self.broadcast_next_backup_time()
+
     @new_thread(thread_name("timer"))
     def run(self):
         self.running = True
         while self.running:  # loop until stop
-            while self.running:  # loop for backup interval
-                time.sleep(0.1)
-                if time.time() - self.time_since_backup > self.get_backup_interval():
-                    break
-            if self.is_enabled and self.server.is_server_startup():
-                self.broadcast(
-                    self.tr("run.trigger_time", self.get_interval()))
-                self.is_backup_triggered = False
-
-                better_backup.operations.do_create(
-                    self.server.get_plugin_command_source(),
-                    str(self.tr("run.timed_backup", "timer")),
-                )
-
-                if self.is_backup_triggered:
-                    self.broadcast(self.tr("on_backup_succeed"))
-                else:
-                    self.broadcast(self.tr("on_backup_failed"))
-                    self._reset()
-                    self.broadcast_next_backup_time()
+            self.wakeup.clear()
+            next_time = self.get_next_backup_time()
+            delay = TIMER_MAX_SLEEP if next_time is None else next_time - time.time()
+            if self.is_enabled and delay <= 0 and self.server.is_server_startup():
+                self.trigger()
+            else:
+                # sleep until the backup is due, or something changes it. the limit follows clock changes
+                self.wakeup.wait(min(delay, TIMER_MAX_SLEEP) if delay > 0 else TIMER_MAX_SLEEP)
 
     def stop(self):
         self.running = False
+        self.wakeup.set()
 
     def show_status(self, source: CommandSource):
         print_message(
@@ -117,6 +228,17 @@ class Timer():
             Timer.tr("status.clock_interval", round(config.timer_interval, 2)),
             reply_source=True,
         )
+        if self.cron_schedules:
+            print_message(
+                source,
+                Timer.tr("status.cron", " §l|§r ".join(schedule.expression for schedule in self.cron_schedules)),
+                reply_source=True,
+            )
+        if self.quiet_hours:
+            print_message(source, Timer.tr("status.quiet_hours", ", ".join(config.timer_quiet_hours)), reply_source=True)
+        print_message(
+            source, Timer.tr("status.has_online_player", len(self.online_players) > 0), reply_source=True
+        )
         if self.is_enabled:
             print_message(source, self.get_next_backup_message(),
                           reply_source=True)
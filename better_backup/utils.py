@@ -1,21 +1,48 @@
 import pyzstd
 import functools
 # import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import xxhash
 import os
+import posixpath
 import tarfile
+import threading
 import time
 import uuid
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
-from shutil import copyfile, copytree, rmtree
+from queue import Queue
+from shutil import copy2, copyfile, copyfileobj, copytree, move, rmtree
 from threading import Lock
 from typing import Any, Callable, Optional
 
 from mcdreforged.api.all import *
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from better_backup.blob_index import BlobIndex
+from better_backup.chunking import REGION_EXTS, REGION_HEADER_SIZE, split_cdc, split_region
+from better_backup.compression import (DECOMPRESS_OPTION, DICT_CLASSES, get_compress_option,
+                                       get_file_class, get_frame_dict_id)
 from better_backup.config import Configuration, config
-from better_backup.constants import CACHE_DIR, PLUGIN_ID, TEMP_DIR, ZST_EXT
-from better_backup.database import database
+from better_backup.constants import (CACHE_DIR, DICT_DIR, DICT_MAX_FILE_SIZE,
+                                     CACHE_READ_SIZE, DICT_MIN_SAMPLES, FICLONE, PACK_DIR,
+                                     PLUGIN_ID, PROGRESS_INTERVAL,
+                                     REPACK_GARBAGE_RATIO, RESTORE_READ_SIZE,
+                                     STAGE_DIR, TEMP_DIR, VERIFY_STATE_FILE,
+                                     ZST_EXT, ZSTD_THREADS_MIN_SIZE)
+from better_backup.database import (bulk_insert, bulk_update, database,
+                                    get_chain_length, hash_id,
+                                    manifest_entries, manifest_reach,
+                                    write_delta)
+from better_backup.pack import PackReader, PackWriter, get_pack_file, list_packs
 
 # pyzstd = None
 # try:
@@ -27,6 +54,11 @@ from better_backup.database import database
 operation_lock = Lock()
 operation_name = RText("?")
 
+pack_reader = PackReader(os.path.join(config.backup_data_path, PACK_DIR))
+packed_blobs: Optional[dict] = None  # hash -> (pack, start, length, compressed), loaded on first use
+packed_lock = Lock()
+cached_blobs: Optional[BlobIndex] = None  # hash -> (stored size or None if not known yet, compressed), loaded on first use
+
 
 class ExportFormat(Enum):
     plain = ("", False)
@@ -78,6 +110,16 @@ class Backup:
     time: int
     size: int
     message: str
+    id: Optional[int] = None  # row id, manifest refers to it
+    parent_id: Optional[int] = None  # manifest only records the changes from this backup
+    logical_size: Optional[int] = None
+    stored_size: Optional[int] = None
+    new_size: Optional[int] = None
+    unique_size: Optional[int] = None
+    file_count: int = 0
+    skipped_count: int = 0  # files whose hash was reused from the fingerprint index
+    restored_count: int = 0
+    removed_count: int = 0
 
     def __init__(self, uuid, time, size, message) -> None:
         self.uuid = uuid
@@ -86,20 +128,48 @@ class Backup:
         self.message = message
 
     @classmethod
-    def insert_new(cls, uuid, time, size, message) -> 'Backup':
+    def insert_new(cls, uuid, time, size, message, **sizes) -> 'Backup':
         backup = Backup(uuid, time, size, message)
-        database.backups.insert(
-            uuid=uuid,
-            time=time,
-            size=size,
-            message=message
-        )
-        database.commit()
+        backup.insert(**sizes)
         return backup
 
+    def insert(self, **sizes):
+        """sizes are the accounting columns, logical_size, stored_size, new_size and unique_size"""
+        for name, value in sizes.items():
+            setattr(self, name, value)
+        self.id = int(database.backups.insert(
+            uuid=self.uuid,
+            time=self.time,
+            size=self.size,
+            message=self.message,
+            parent_id=self.parent_id,
+            **sizes
+        ))
+
+    def update_sizes(self, size, **sizes):
+        """fill in the sizes of an inserted backup once its files are counted"""
+        self.size = size
+        for name, value in sizes.items():
+            setattr(self, name, value)
+        database(database.backups.id == self.id).update(size=size, **sizes)
+
     @classmethod
     def from_row(cls, row):
-        return Backup(row.uuid, row.time, row.size, row.message)
+        backup = Backup(row.uuid, row.time, row.size, row.message)
+        backup.id, backup.parent_id = row.id, row.parent_id
+        backup.logical_size, backup.stored_size = row.logical_size, row.stored_size
+        backup.new_size, backup.unique_size = row.new_size, row.unique_size
+        return backup
+
+    @property
+    def dedup_ratio(self) -> Optional[float]:
+        """logical bytes per stored byte"""
+        if self.logical_size is None or not self.stored_size:
+            return None
+        return self.logical_size / self.stored_size
+
+
+BackupFile = namedtuple("BackupFile", ["path", "name", "hash", "size", "dict_id"])
 
 
 class MetadataError(SyntaxError):
@@ -178,53 +248,506 @@ def get_stream_hash(obj, range_size: int = 1024 * 128) -> str:
     """通过文件对象获取文件的hash值"""
     # hash = hashlib.md5()
     hash = xxhash.xxh3_64()
+    buffer = bytearray(range_size)
+    view = memoryview(buffer)
     while True:
-        data = obj.read(range_size)
-        if not data:
+        length = obj.readinto(buffer)
+        if not length:
             break
-        hash.update(data)
+        hash.update(view[:length])
     return hash.hexdigest()
 
 
-def cache_file(src_file: str):
-    """获取文件的hash值，并将文件复制到缓存文件夹中"""
+def get_zstd_option(level: int, size: Optional[int] = None) -> dict:
+    """compression parameters from config, size is the input size if known"""
+    threads = config.zstd_threads if size is None or size >= ZSTD_THREADS_MIN_SIZE else 0
+    return get_compress_option(level, threads, config.zstd_long_distance, config.zstd_window_log)
+
+
+def get_dict_file(dict_id: int) -> str:
+    return os.path.join(config.backup_data_path, DICT_DIR, f"{dict_id}.zdict")
+
+
+@functools.lru_cache()
+def load_zstd_dict(dict_id: int) -> pyzstd.ZstdDict:
+    with open(get_dict_file(dict_id), "rb") as fdict:
+        return pyzstd.ZstdDict(fdict.read())
+
+
+def get_zstd_dict(dict_id: Optional[int]) -> Optional[pyzstd.ZstdDict]:
+    return load_zstd_dict(dict_id) if dict_id else None
+
+
+def read_frame_dict(fsrc) -> Optional[pyzstd.ZstdDict]:
+    """dictionary of the zstd frame fsrc starts with, fsrc is left at its start"""
+    zstd_dict = get_zstd_dict(get_frame_dict_id(fsrc.read(18)))
+    fsrc.seek(0)
+    return zstd_dict
+
+
+def get_blob_dict_id(hash: str) -> Optional[int]:
+    """dictionary a cached blob was compressed with, read from its frame header"""
+    location = get_packed_blobs().get(hash)
+    if location is not None:
+        pack, start, length, compressed = location
+        return get_frame_dict_id(pack_reader.read(pack, start, min(length, 18))) if compressed else None
+    blob_file = get_blob_file(hash)
+    if blob_file is None or not blob_file[1]:
+        return None
+    try:
+        with open(blob_file[0], "rb") as fsrc:
+            return get_frame_dict_id(fsrc.read(18))
+    except FileNotFoundError:
+        return None
+
+
+def get_current_dicts() -> dict:
+    """file class -> id of its latest dictionary"""
+    return dict(database.executesql(
+        "SELECT file_class, dict_id FROM dictionaries ORDER BY version;"
+    ))
+
+
+def get_packed_blobs() -> dict:
+    """
+    index of every packed blob, kept in memory as it is asked for each file.
+    load it before starting process workers, they must not touch the database
+    """
+    global packed_blobs
+    with packed_lock:
+        if packed_blobs is None:
+            packed_blobs = {
+                row[0]: tuple(row[1:])
+                for row in database.executesql("SELECT hash, pack, start, length, compressed FROM packed;")
+            }
+        return packed_blobs
+
+
+def forget_packed_blobs():
+    """reload the index on next use"""
+    global packed_blobs
+    with packed_lock:
+        packed_blobs = None
+
+
+def get_cached_blobs() -> BlobIndex:
+    """
+    index of the blob files in the cache folder, so that looking a blob up takes no stat.
+    names come from listing the folder once, sizes from blobs table. load it before starting process workers too
+    """
+    global cached_blobs
+    with packed_lock:
+        if cached_blobs is None:
+            sizes = dict(database.executesql("SELECT hash_id(hash), size FROM blobs;"))
+            cache_dir = os.path.join(config.backup_data_path, CACHE_DIR)
+            blobs = []
+            for prefix in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+                if not os.path.isdir(os.path.join(cache_dir, prefix)):
+                    continue
+                for name in os.listdir(os.path.join(cache_dir, prefix)):
+                    if name.endswith(".tmp"):
+                        continue
+                    compressed = name.endswith(ZST_EXT)
+                    try:
+                        key = hash_id(prefix + (name[:-len(ZST_EXT)] if compressed else name))
+                    except ValueError:  # not a blob
+                        continue
+                    blobs.append((key, sizes.get(key), compressed))
+            cached_blobs = BlobIndex(blobs)
+        return cached_blobs
+
+
+def forget_cached_blobs():
+    """list the cache folder again on next use"""
+    global cached_blobs
+    with packed_lock:
+        cached_blobs = None
+
+
+def remember_cached_blobs(new_blobs: list, packing: list = ()):
+    """
+    add blobs written to the cache folder to its index as (hash, stored size).
+    hashes in packing, the blobs to pack of the same file, are not written to the folder
+    """
+    cached, packed = get_cached_blobs(), get_packed_blobs()
+    packing = {blob[0] for blob in packing}
+    for hash, size in new_blobs:
+        if hash not in cached and hash not in packed and hash not in packing:
+            cached[hash] = (size, bool(config.backup_compress_level))
+
+
+def get_blob_file(hash: str) -> Optional[tuple]:
+    """(file, compressed) of a blob in the cache folder, None if it is not there"""
+    cached = get_cached_blobs().get(hash)
+    if cached is None:
+        return None
+    return get_cached_file(hash) + (ZST_EXT if cached[1] else ""), cached[1]
+
+
+def use_pack(size: int) -> bool:
+    return config.blob_store == "pack" and size <= config.pack_blob_size
+
+
+def read_packed(location: tuple) -> bytes:
+    """original content of a packed blob, decompressed with the dictionary named in its frame"""
+    pack, start, length, compressed = location
+    data = pack_reader.read(pack, start, length)
+    if compressed:
+        data = pyzstd.decompress(data, get_zstd_dict(get_frame_dict_id(data[:18])), DECOMPRESS_OPTION)
+    return data
+
+
+def get_cached_size(hash: str) -> Optional[int]:
+    """stored size of a cached file, None if it is not in the cache"""
+    location = get_packed_blobs().get(hash)
+    if location is not None:
+        return location[2]
+    cached = get_cached_blobs().get(hash)
+    if cached is None:
+        return None
+    size, compressed = cached
+    if size is None:  # in the folder but not counted in blobs table, left by an interrupted backup
+        try:
+            size = os.path.getsize(get_blob_file(hash)[0])
+        except FileNotFoundError:
+            return None
+        get_cached_blobs()[hash] = (size, compressed)
+    return size
+
+
+def get_stored_size(hash: str) -> Optional[int]:
+    """like get_cached_size, also counts files stored in chunks"""
+    size = get_cached_size(hash)
+    if size is None:
+        total = database.chunks.size.sum()
+        size = database(database.chunks.hash == hash).select(total).first()[total]
+    return size
+
+
+def store_blob(hash: str, data: bytes, blobs: list) -> int:
+    """
+    cache data under given hash if absent, returns the stored size.
+    blobs to pack are added to blobs as (hash, stored data, compressed), the backup writer appends them
+    """
+    size = get_cached_size(hash)
+    if size is None:
+        packed = use_pack(len(data))
+        dst_file = get_cached_file(hash)
+        if config.backup_compress_level:
+            dst_file += ZST_EXT
+            data = pyzstd.compress(data, get_zstd_option(config.backup_compress_level, len(data)))
+        if packed:
+            blobs.append((hash, bytes(data), bool(config.backup_compress_level)))
+        else:
+            with open(get_temp_file(dst_file), "wb") as fdst:
+                fdst.write(data)
+            os.replace(fdst.name, dst_file)
+            remember_cached_blobs([(hash, len(data))])
+        size = len(data)
+    return size
+
+
+def get_chunker(src_file: str, size: int) -> Optional[Callable]:
+    """how to split the file into chunks, None to cache it as a whole"""
+    if config.region_dedup and src_file.endswith(REGION_EXTS):
+        return split_region if size >= REGION_HEADER_SIZE else None
+    if 0 < config.chunking_threshold < size:
+        return functools.partial(split_cdc, avg_size=config.chunking_avg_size)
+    return None
+
+
+def cache_chunked_file(fsrc, chunker: Callable, blobs: list) -> Optional[tuple]:
+    """cache every chunk of the file on its own, None if the chunker refuses the file"""
+    with mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+        ranges = chunker(view)
+        if ranges is None:
+            return None
+        hash = xxhash.xxh3_64_hexdigest(view)
+        size = get_cached_size(hash)
+        if size is not None:  # cached as a whole before
+            return size, hash, None, len(view), get_blob_dict_id(hash), blobs
+        size = 0
+        chunks = []
+        for start, end in ranges:
+            chunk_hash = xxhash.xxh3_64_hexdigest(view[start:end])
+            chunk_size = store_blob(chunk_hash, view[start:end], blobs)
+            chunks.append((chunk_hash, chunk_size))
+            size += chunk_size
+        return size, hash, chunks, len(view), None, blobs
+
+
+def cache_file(src_file: str, dict_id: Optional[int] = None):
+    """
+    获取文件的hash值，并将文件复制到缓存文件夹中
+    dict_id is the dictionary to compress with if the file is not cached yet,
+    returns (stored size, hash, chunks or None, original size, dictionary of the cached blob, blobs to pack)
+    """
     # os.makedirs(os.path.split(src_file)[0], exist_ok=True)
+    blobs = []
     with open(src_file, "rb") as fsrc:
-        hash = get_stream_hash(fsrc)
-        dst_file = get_cached_file(hash)
-        zst_dst_file = dst_file + ZST_EXT
-        fsrc.seek(0, 0)
-        if os.path.exists(zst_dst_file):
-            size = os.path.getsize(zst_dst_file)
-        elif os.path.exists(dst_file):
-            size = os.path.getsize(dst_file)
+        raw_size = os.fstat(fsrc.fileno()).st_size
+        chunker = get_chunker(src_file, raw_size)
+        if chunker is not None:
+            result = cache_chunked_file(fsrc, chunker, blobs)
+            if result is not None:
+                return result
+        if not use_pack(raw_size):
+            size, hash, raw_size, dict_id = write_new_blob(fsrc, raw_size, dict_id)
+            return size, hash, None, raw_size, dict_id, blobs
+        data = fsrc.read()  # small enough to hash and compress in memory
+        raw_size = len(data)
+        hash = xxhash.xxh3_64_hexdigest(data)
+        size = get_cached_size(hash)
+        if size is not None:
+            dict_id = get_blob_dict_id(hash)
         else:
             if config.backup_compress_level:
-                # if pyzstd is None:  # just raise
-                #     raise ModuleNotFoundError(
-                #         tr("create_backup.zstd_not_found")
-                #     )
-                with open(zst_dst_file, "wb") as fdst:
-                    pyzstd.compress_stream(
-                        fsrc, fdst, level_or_option=config.backup_compress_level
-                    )
-                    size = fdst.tell()
+                data = pyzstd.compress(
+                    data, get_zstd_option(config.backup_compress_level, raw_size), get_zstd_dict(dict_id)
+                )
             else:
-                with open(dst_file, "wb") as fdst:
-                    while True:
-                        data = fsrc.read(131072)
-                        if not data:
-                            break
-                        fdst.write(data)
-    return size, hash
-
-
-def get_dir_size(dir_path: str) -> int:
-    size = 0
-    for root, _, files in os.walk(dir_path):
-        size += sum([os.path.getsize(os.path.join(root, name))
-                    for name in files])
-    return size
+                dict_id = None
+            blobs.append((hash, data, bool(config.backup_compress_level)))
+            size = len(data)
+    return size, hash, None, raw_size, dict_id, blobs
+
+
+def write_new_blob(fsrc, raw_size: int, dict_id: Optional[int] = None) -> tuple:
+    """
+    hash and compress the file in a single read through one buffer, into a temp file that is renamed
+    to the blob, or dropped if that content is cached already. returns (stored size, hash, original size, dict_id)
+    """
+    hash = xxhash.xxh3_64()
+    compressor = None
+    if config.backup_compress_level:
+        # if pyzstd is None:  # just raise
+        #     raise ModuleNotFoundError(
+        #         tr("create_backup.zstd_not_found")
+        #     )
+        compressor = pyzstd.ZstdCompressor(
+            get_zstd_option(config.backup_compress_level, raw_size), get_zstd_dict(dict_id)
+        )
+    else:
+        dict_id = None
+    buffer = bytearray(CACHE_READ_SIZE)
+    view = memoryview(buffer)
+    raw_size = 0
+    # the hash is not known yet, the name only has to be unique and on the same filesystem as the cache
+    temp_file = get_temp_file(os.path.join(config.backup_data_path, CACHE_DIR, "new"))
+    try:
+        with open(temp_file, "wb") as fdst:
+            while True:
+                length = fsrc.readinto(buffer)
+                if not length:
+                    break
+                data = view[:length]
+                hash.update(data)
+                fdst.write(compressor.compress(data) if compressor is not None else data)
+                raw_size += length
+            if compressor is not None:
+                fdst.write(compressor.flush())
+            size = fdst.tell()
+        hash = hash.hexdigest()
+        cached_size = get_cached_size(hash)
+        if cached_size is not None:
+            os.remove(temp_file)
+            return cached_size, hash, raw_size, get_blob_dict_id(hash)
+        dst_file = get_cached_file(hash) + (ZST_EXT if compressor is not None else "")
+        if not publish_blob(temp_file, dst_file):
+            # cached by another worker meanwhile, maybe with another dictionary, the rows describe its blob
+            os.remove(temp_file)
+            with open(dst_file, "rb") as fsrc:
+                dict_id = get_frame_dict_id(fsrc.read(18)) if compressor is not None else None
+                size = os.fstat(fsrc.fileno()).st_size
+        remember_cached_blobs([(hash, size)])
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return size, hash, raw_size, dict_id
+
+
+def publish_blob(temp_file: str, dst_file: str) -> bool:
+    """
+    move a finished temp file to its blob name, False if that blob exists already.
+    the first one wins so that the manifest rows of both workers describe the blob on disk
+    """
+    try:
+        os.link(temp_file, dst_file)
+    except FileExistsError:
+        return False
+    except OSError:  # no hard links on this filesystem
+        os.replace(temp_file, dst_file)
+        return True
+    os.remove(temp_file)
+    return True
+
+
+def get_temp_file(dst_file: str) -> str:
+    """unique name to write to, workers caching the same content must not share a file"""
+    return f"{dst_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def get_worker_count(workers: int) -> int:
+    """0 means one worker per cpu"""
+    return workers if workers > 0 else os.cpu_count() or 1
+
+
+def get_executor(workers: int, worker_type: str = "thread") -> Executor:
+    """worker pool for hashing and compression"""
+    # child processes have to inherit the loaded plugin, spawn would import it without MCDR
+    if worker_type == "process" and "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(workers, thread_name_prefix=thread_name("worker"))
+
+
+class BackupWriter:
+    """the only thread writing to database while a backup is being created, backup is inserted first"""
+
+    def __init__(self, backup: Backup, batch_size: int = 1000):
+        self.backup = backup
+        self.path_ids: Optional[dict] = None  # (path, name) -> id in paths table
+        # path id -> (hash, size, dict_id) of the files of the parent backup not seen yet
+        self.parent_files: Optional[dict] = None
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=batch_size * 4)
+        self.aborted = False
+        self.finalize: Optional[Callable] = None
+        self.error: Optional[BaseException] = None
+        self.files = []
+        self.new_fingerprints = []
+        self.changed_fingerprints = []
+        self.chunks = []
+        self.chunked_hashes = set()
+        self.packed = []
+        self.new_packed = {}  # hash -> location of blobs appended by this backup
+        self.new_packed_dicts = {}  # hash -> dictionary of blobs appended by this backup
+        self.pack_writer: Optional[PackWriter] = None
+        self.thread = threading.Thread(
+            target=self.run, name=thread_name("backup_writer"), daemon=True
+        )
+        self.thread.start()
+
+    def put(
+        self, file_row: dict, fingerprint: Optional[tuple] = None, chunks: Optional[list] = None, blobs: list = ()
+    ):
+        self.queue.put((file_row, fingerprint, chunks, blobs))
+
+    def add(self, file_row: dict, fingerprint: Optional[tuple], chunks: Optional[list], blobs: list):
+        for hash, data, compressed in blobs:  # the same blob may come from files cached at the same time
+            if hash in self.new_packed or hash in get_packed_blobs():
+                if hash == file_row["hash"]:  # payload dropped, the row describes the blob kept
+                    kept = self.new_packed_dicts
+                    file_row["dict_id"] = kept[hash] if hash in kept else get_blob_dict_id(hash)
+                continue
+            if self.pack_writer is None:
+                self.pack_writer = PackWriter(os.path.join(config.backup_data_path, PACK_DIR), config.pack_size)
+            pack, start = self.pack_writer.append(data)
+            self.new_packed[hash] = (pack, start, len(data), int(compressed))
+            self.new_packed_dicts[hash] = get_frame_dict_id(data[:18]) if compressed else None
+            self.packed.append(
+                dict(hash=hash, pack=pack, start=start, length=len(data), compressed=int(compressed))
+            )
+        self.files.append(file_row)
+        if fingerprint is not None:
+            path, (size, mtime_ns, inode), hash, old = fingerprint
+            if old is None:
+                self.new_fingerprints.append(
+                    dict(path=path, size=size, mtime_ns=mtime_ns, inode=inode, hash=hash)
+                )
+            else:
+                self.changed_fingerprints.append((size, mtime_ns, inode, hash, old[0]))
+        hash = file_row["hash"]
+        if chunks and hash not in self.chunked_hashes:
+            self.chunked_hashes.add(hash)
+            if database(database.chunks.hash == hash).isempty():
+                self.chunks.extend(
+                    dict(hash=hash, seq=seq, chunk_hash=chunk_hash, size=size)
+                    for seq, (chunk_hash, size) in enumerate(chunks)
+                )
+
+    def get_path_id(self, path: str, name: str) -> int:
+        if self.path_ids is None:
+            self.path_ids = {
+                (path, name): id for id, path, name in database.executesql("SELECT id, path, name FROM paths;")
+            }
+        path_id = self.path_ids.get((path, name))
+        if path_id is None:
+            path_id = self.path_ids[(path, name)] = database._adapter.connection.execute(
+                "INSERT INTO paths (path, name) VALUES (?, ?);", (path, name)
+            ).lastrowid
+        return path_id
+
+    def load_parent_files(self):
+        if self.backup.parent_id is not None:
+            self.parent_files = {
+                path_id: (hash, size, dict_id) for path_id, hash, size, dict_id in database.executesql(
+                    manifest_entries("id = ?") + "SELECT path_id, hash, size, dict_id FROM entries;",
+                    placeholders=[self.backup.parent_id],
+                )
+            }
+
+    def flush(self):
+        manifest = []
+        for row in self.files:
+            path_id = self.get_path_id(row["path"], row["name"])
+            entry = (hash_id(row["hash"]), row["size"], row["dict_id"])
+            if self.parent_files is None or self.parent_files.pop(path_id, None) != entry:  # new or changed
+                manifest.append(
+                    dict(backup_id=self.backup.id, path_id=path_id, hash=entry[0], size=entry[1], dict_id=entry[2])
+                )
+        bulk_insert("manifest", manifest)
+        bulk_insert("fingerprints", self.new_fingerprints)
+        bulk_update("fingerprints", ["size", "mtime_ns", "inode", "hash"], self.changed_fingerprints)
+        bulk_insert("chunks", self.chunks)
+        bulk_insert("packed", self.packed)
+        self.files, self.new_fingerprints, self.changed_fingerprints, self.chunks = [], [], [], []
+        self.packed = []
+
+    def run(self):
+        item = None
+        try:
+            self.backup.insert()
+            self.load_parent_files()
+            while True:
+                item = self.queue.get()
+                if item is not None:
+                    self.add(*item)
+                if item is None or len(self.files) >= self.batch_size:
+                    self.flush()
+                if item is None:
+                    break
+            if self.parent_files:  # removed since the parent
+                bulk_insert("manifest", [
+                    dict(backup_id=self.backup.id, path_id=path_id, hash=None, size=None, dict_id=None)
+                    for path_id in self.parent_files
+                ])
+            if self.pack_writer is not None:
+                self.pack_writer.close()
+            if self.aborted:
+                database.rollback()
+            else:
+                if self.finalize is not None:
+                    self.finalize()
+                database.commit()  # the whole backup is a single transaction
+                get_packed_blobs().update(self.new_packed)
+        except BaseException as e:
+            self.error = e
+            database.rollback()
+            if self.pack_writer is not None:  # appended blobs are left for repack
+                self.pack_writer.close()
+            while item is not None:  # keep draining so that put() never blocks
+                item = self.queue.get()
+
+    def close(self, commit: bool = True, finalize: Optional[Callable] = None):
+        """finalize runs in the writer thread right before commit"""
+        self.aborted = not commit
+        self.finalize = finalize
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None and commit:
+            raise self.error
+
 
 def ignore_files_and_folders(src: str, names: list) -> list:
     ignore_names = []
@@ -244,70 +767,371 @@ def clear_tree(path: str):
             rmtree(os.path.join(root, dir))
 
 def temp_and_clear(*src_dirs: str, temp_dir: str = TEMP_DIR, src_path: str = None):
-    """temp source dirs to avoid idiot"""
+    """temp source dirs to avoid idiot, server must be stopped"""
     os.makedirs(temp_dir, exist_ok=True)
     for src_dir in src_dirs:
         source_dir = os.path.join(src_path, src_dir) if src_path else src_dir
         destination_dir = os.path.join(temp_dir, src_dir)
-        copytree(
-            source_dir,
-            destination_dir,
-            dirs_exist_ok=True,
-            ignore=ignore_files_and_folders,
-        )
+        snapshot_dir(source_dir, destination_dir)
 
-    # copy all then delete all
+    # move or link all then delete what is left
     for src_dir in src_dirs:
         full_src_dir = os.path.join(src_path, src_dir) if src_path else src_dir
 
         if os.path.islink(full_src_dir):
             os.unlink(full_src_dir)
-        else:
+        elif os.path.exists(full_src_dir):
             rmtree(full_src_dir)
         os.makedirs(full_src_dir, exist_ok=True)
 
 
+def snapshot_dir(src: str, dst: str):
+    """
+    rename src to dst, which takes no time on the same filesystem.
+    hardlink or copy its files instead when that is impossible (another filesystem,
+    a mount point) or dst is a snapshot left by an interrupted restore
+    """
+    if not os.path.lexists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.rename(src, dst)
+            return
+        except OSError:
+            pass
+    copytree(
+        src,
+        dst,
+        dirs_exist_ok=True,
+        ignore=ignore_files_and_folders,
+        copy_function=link_or_copy,
+    )
+
+
+def link_or_copy(src: str, dst: str):
+    if os.path.lexists(dst):  # never write through an existing link
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+
+def clone_or_copy(src: str, dst: str):
+    """
+    reflink dst to src where the filesystem supports it (btrfs, xfs), which shares the data until either is written.
+    a hardlink would not do as the game writes region files in place
+    """
+    if fcntl is not None:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+    copyfile(src, dst)
+
 
 def restore_temp(
     *src_dirs: str,
     temp_dir: str = TEMP_DIR,
-    config: Configuration = None,
+    src_path: str = None,
 ):
-    src_path = config.server_path
+    """put the dirs saved by temp_and_clear back"""
     for src_dir in src_dirs:
-        os.removedirs(os.path.join(src_path, src_dir))
-        os.makedirs(os.path.join(src_path, src_dir))
-
-        copytree(
-            os.path(temp_dir, src_dir),
-            os.path.join(src_path, src_dir),
-            dirs_exist_ok=True,
-            ignore=ignore_files_and_folders,
-        )
+        full_src_dir = os.path.join(src_path, src_dir) if src_path else src_dir
+        temp_src_dir = os.path.join(temp_dir, src_dir)
+        if not os.path.lexists(temp_src_dir):
+            continue
+        if os.path.islink(full_src_dir):
+            os.unlink(full_src_dir)
+        elif os.path.exists(full_src_dir):
+            rmtree(full_src_dir)
+        move(temp_src_dir, full_src_dir)
 
 
 def clear_temp(temp_dir: str = TEMP_DIR):
-    rmtree(temp_dir)
+    if os.path.exists(temp_dir):  # incremental restore may have nothing to keep
+        rmtree(temp_dir)
 
 
 def get_cached_file(hash: str):
     return os.path.join(config.backup_data_path, CACHE_DIR, hash[:2], hash[2:])
 
 
+def get_stat_fingerprint(stat: os.stat_result) -> tuple:
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def load_fingerprints() -> dict:
+    """path -> (id, size, mtime_ns, inode, hash)"""
+    return {
+        row[1]: (row[0], *row[2:])
+        for row in database.executesql(
+            "SELECT id, path, size, mtime_ns, inode, hash FROM fingerprints;"
+        )
+    }
+
+
+def remove_fingerprints(ids: list):
+    if ids:
+        database(database.fingerprints.id.belongs(ids)).delete()
+
+
 def get_backup_files(uuid: str) -> list:
-    return database(database.files.backup_uuid == uuid).select(database.files.ALL)
+    """BackupFile of every file, put together from the manifests of the backup and its parents"""
+    return [BackupFile(*row) for row in database.executesql(
+        manifest_entries("uuid = ?") + "SELECT paths.path, paths.name, printf('%016x', entries.hash), "
+        "entries.size, entries.dict_id FROM entries JOIN paths ON paths.id = entries.path_id "
+        "ORDER BY paths.path, paths.name;",
+        placeholders=[uuid],
+    )]
+
+
+def get_backup_chunks(uuid: str) -> dict:
+    """hash -> chunk hashes in order, for files of the backup stored in chunks"""
+    chunks = {}
+    rows = database.executesql(
+        manifest_entries("uuid = ?") + "SELECT hash, chunk_hash FROM chunks "
+        "WHERE hash IN (SELECT printf('%016x', hash) FROM entries) ORDER BY hash, seq;",
+        placeholders=[uuid],
+    )
+    for hash, chunk_hash in rows:
+        chunks.setdefault(hash, []).append(chunk_hash)
+    return chunks
+
+
+def get_backup_file_count(backup_id: int) -> int:
+    return database.executesql(
+        manifest_entries("id = ?") + "SELECT COUNT(*) FROM entries;", placeholders=[backup_id]
+    )[0][0]
+
+
+def get_delta_parent(latest) -> Optional[int]:
+    """
+    id of the backup a new one only records the changes from, usually the latest.
+    None for a full manifest, every manifest_checkpoint_interval backups
+    """
+    if latest is None or get_chain_length(latest.id) + 1 >= config.manifest_checkpoint_interval:
+        return None
+    return latest.id
+
+
+def read_blob(hash: str, fdst):
+    """write the original content of a cached blob to fdst"""
+    location = get_packed_blobs().get(hash)
+    if location is not None:
+        fdst.write(read_packed(location))
+        return
+    blob_file = get_blob_file(hash)
+    if blob_file is None:
+        return
+    src_file, compressed = blob_file
+    with open(src_file, "rb") as fsrc:
+        if compressed:
+            pyzstd.decompress_stream(fsrc, fdst, zstd_dict=read_frame_dict(fsrc), option=DECOMPRESS_OPTION)
+        else:
+            copyfileobj(fsrc, fdst)
+
+
+def open_blob(hash: str):
+    """file object reading the original content of a cached blob, None if it is missing"""
+    location = get_packed_blobs().get(hash)
+    if location is not None:
+        return io.BytesIO(read_packed(location))
+    blob_file = get_blob_file(hash)
+    if blob_file is None:
+        return None
+    src_file, compressed = blob_file
+    if compressed:
+        with open(src_file, "rb") as fsrc:
+            zstd_dict = read_frame_dict(fsrc)
+        return pyzstd.ZstdFile(src_file, "rb", level_or_option=DECOMPRESS_OPTION, zstd_dict=zstd_dict)
+    return open(src_file, "rb")
+
+
+class BlobReader(io.RawIOBase):
+    """reads the blobs one after another as a single stream, missing blobs read as empty"""
+
+    def __init__(self, hashes: list):
+        self.hashes = deque(hashes)
+        self.blob = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self.blob is None:
+                if not self.hashes:
+                    return 0
+                self.blob = open_blob(self.hashes.popleft())
+                if self.blob is None:
+                    continue
+            count = self.blob.readinto(buffer)
+            if count:
+                return count
+            self.blob.close()
+            self.blob = None
+
+    def close(self):
+        if self.blob is not None:
+            self.blob.close()
+            self.blob = None
+        super().close()
+
+
+def open_backup_file(file, chunks: dict):
+    """buffered reader of a file in a backup, reassembled from its chunks if it has any"""
+    reader = BlobReader(chunks.get(file.hash, [file.hash]))
+    return io.BufferedReader(reader, RESTORE_READ_SIZE)
+
+
+def remove_blob(hash: str):
+    """its row in packed table must be deleted already, the pack keeps the bytes until repack"""
+    if get_packed_blobs().pop(hash, None) is not None:
+        return
+    blob_file = get_blob_file(hash)
+    if blob_file is not None:
+        get_cached_blobs().pop(hash, None)
+        try:
+            os.remove(blob_file[0])
+        except FileNotFoundError:
+            pass
 
 
 def get_backup_row(uuid: str):
-    return get_backups(database.backups.uuid == uuid)[0] or None
+    rows = get_backups(database.backups.uuid == uuid, limitby=(0, 1))
+    return rows[0] if rows else None
+
+
+def get_backups(filter=None, orderby=None, limitby=None):
+    return database(filter).select(database.backups.ALL, orderby=orderby, limitby=limitby) or []
+
+
+def get_backup_page(offset: int, limit: int, filter=None) -> list:
+    """newest first, read through the index on time"""
+    return get_backups(
+        filter, orderby=~database.backups.time | ~database.backups.id, limitby=(offset, offset + limit)
+    )
+
+
+def get_backup_by_index(index: int):
+    """1 is the latest backup, None if there are fewer"""
+    if index <= 0:
+        return None
+    rows = get_backup_page(index - 1, 1)
+    return rows[0] if rows else None
 
 
-def get_backups(filter=None, orderby=None):
-    return database(filter).select(database.backups.ALL, orderby=orderby) or []
+def find_backup_by_prefix(prefix: str):
+    """the only backup whose uuid starts with prefix, None if there is none or several"""
+    if not prefix:
+        return None
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)  # a range on the uuid index instead of LIKE
+    rows = get_backups((database.backups.uuid >= prefix) & (database.backups.uuid < end), limitby=(0, 2))
+    return rows[0] if len(rows) == 1 else None
 
 
-def get_files(filter=None, orderby=None):
-    return database(filter).select(database.files.ALL, orderby=orderby)
+def get_backup_count() -> int:
+    count = get_stat("backup_count")
+    return database(database.backups).count() if count is None else count
+
+
+def iter_world_files(*src_dirs: str, src_path: str, config: Configuration):
+    """yields (path relative to src_path, file name) in a stable order"""
+    for src_dir in src_dirs:
+        dir_path = os.path.join(src_path, src_dir)
+        for root, dirs, files in os.walk(dir_path):
+            dirs.sort()
+            for filename in sorted(files):
+                if not (filename in config.ignored_files or os.path.splitext(filename)[1] in config.ignored_extensions or os.path.split(root)[1] in config.ignored_folders):
+                    yield os.path.relpath(root, src_path), filename
+
+
+def iter_world_stats(*src_dirs: str, src_path: str, config: Configuration):
+    """yields (path, file name, file to read, stat fingerprint) of the world files"""
+    for path, filename in iter_world_files(*src_dirs, src_path=src_path, config=config):
+        file = os.path.join(src_path, path, filename)
+        yield path, filename, file, get_stat_fingerprint(os.stat(file))
+
+
+def stage_world_util(*src_dirs: str, src_path: str, config: Configuration) -> tuple:
+    """
+    copy the files a backup has to read to the staging folder, so the game can save again before they are hashed.
+    returns the world in the form of iter_world_stats, the number and size of the staged files
+    """
+    stage_dir = os.path.join(config.backup_data_path, STAGE_DIR)
+    clear_stage()
+    fingerprints = load_fingerprints()
+    get_packed_blobs()
+    get_cached_blobs()
+    world, staged_count, staged_size = [], 0, 0
+    for path, filename, file, stat in iter_world_stats(*src_dirs, src_path=src_path, config=config):
+        old = fingerprints.get(os.path.join(path, filename))
+        # the same test as create_backup_util, files it reuses the hash of are never read
+        if old is None or old[1:4] != stat or config.paranoid_backup or get_stored_size(old[4]) is None:
+            staged_file = os.path.join(stage_dir, path, filename)
+            os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+            clone_or_copy(file, staged_file)
+            file = staged_file
+            staged_count += 1
+            staged_size += stat[0]
+        world.append((path, filename, file, stat))
+    return world, staged_count, staged_size
+
+
+def clear_stage():
+    rmtree(os.path.join(config.backup_data_path, STAGE_DIR), ignore_errors=True)
+
+
+def get_unchanged_backup_util(*src_dirs: str, src_path: str, config: Configuration) -> Optional[Backup]:
+    """
+    the latest backup if the world still has the same files with the same stat, None otherwise.
+    its file_count and logical_size are what a new backup would have walked and covered
+    """
+    latest = get_backup_by_index(1)
+    if latest is None or config.paranoid_backup:
+        return None
+    files = {os.path.join(file.path, file.name): (file.hash, file.size or 0) for file in get_backup_files(latest.uuid)}
+    fingerprints = load_fingerprints()
+    count = 0
+    for path, filename in iter_world_files(*src_dirs, src_path=src_path, config=config):
+        fp_path = os.path.join(path, filename)
+        old = fingerprints.get(fp_path)
+        if (  # stops at the first changed file, nothing is read
+            old is None or fp_path not in files or files[fp_path][0] != old[4]
+            or old[1:4] != get_stat_fingerprint(os.stat(os.path.join(src_path, fp_path)))
+        ):
+            return None
+        count += 1
+    if count != len(files):  # some files were removed
+        return None
+    backup = Backup.from_row(latest)
+    backup.file_count = count
+    backup.logical_size = sum(size for _, size in files.values())
+    return backup
+
+
+def alias_backup_util(backup_uuid: str, message: Optional[str] = None) -> Backup:
+    """record a new backup with the same files as backup_uuid, no file is read and no blob is stored"""
+    create_time = time.time()
+    alias_uuid = uuid.uuid4().hex[:6]
+    source = Backup.from_row(get_backup_row(backup_uuid))
+    backup_info = Backup(alias_uuid, create_time, source.size, message)
+    backup_info.parent_id = source.id  # nothing changed, its own manifest is empty
+    backup_info.insert()
+    if get_delta_parent(source) is None:
+        write_delta(backup_info.id, None)
+    file_count = get_backup_file_count(backup_info.id)
+    stored_size, new_size, unique_size = add_backup_refs(alias_uuid, {})
+    backup_info.update_sizes(
+        source.size,
+        logical_size=source.logical_size, stored_size=stored_size, new_size=new_size, unique_size=unique_size,
+    )
+    add_stat("backup_count", 1)
+    database.commit()
+    backup_info.file_count = backup_info.skipped_count = file_count
+    return backup_info
 
 
 def create_backup_util(
@@ -315,85 +1139,875 @@ def create_backup_util(
     message: Optional[str] = None,
     src_path: str = None,
     config: Configuration = None,
+    world: Optional[list] = None,
 ) -> dict:
+    """world is what stage_world_util returns, the files are walked and read in place if it is None"""
     create_time = time.time()
     backup_uuid = uuid.uuid4().hex[:6]  # 6 位 UUID 不可能撞吧...
-    total_size = 0
-    for src_dir in src_dirs:
-        dir_path = os.path.join(src_path, src_dir)
-        for root, _, files in os.walk(dir_path):
-            for filename in files:
-                if not (filename in config.ignored_files or os.path.splitext(filename)[1] in config.ignored_extensions or os.path.split(root)[1] in config.ignored_folders):
-                    path = os.path.relpath(root, src_path)
-                    file = os.path.join(root, filename)
-                    size, hash = cache_file(file)
-                    total_size += size
-                    database.files.insert(
-                        backup_uuid=backup_uuid,
-                        name=filename,
-                        path=path,
-                        hash=hash,
-                        # hash_type="md5"
-                    )
-    database.commit()
+    total_size = logical_size = 0
+    file_count = skipped_count = 0
+    fingerprints = load_fingerprints()
+    seen_paths = set()
+    get_packed_blobs()
+    get_cached_blobs()
+    dicts = get_current_dicts() if config.dict_compression else {}
+    stored_sizes = {}  # hash -> stored size of the files not stored in chunks
+    blob_dicts = dict(database.executesql(  # for files whose hash is reused from fingerprints
+        "SELECT DISTINCT printf('%016x', hash), dict_id FROM manifest WHERE dict_id IS NOT NULL;"
+    ))
+
+    # files are hashed and compressed by the pool, results are collected in walk order
+    workers = get_worker_count(config.backup_workers)
+    executor = get_executor(workers, config.backup_worker_type)
+    backup = Backup(backup_uuid, create_time, 0, message)
+    backup.parent_id = get_delta_parent(get_backup_by_index(1))
+    writer = BackupWriter(backup)
+    pending = deque()
+    window = workers * 4
+
+    def collect():
+        nonlocal total_size, logical_size, file_count
+        path, filename, fingerprint, result = pending.popleft()
+        size, hash, chunks, raw_size, dict_id, blobs = result.result() if isinstance(result, Future) else result
+        file_count += 1
+        total_size += size
+        logical_size += raw_size
+        if chunks is None:
+            stored_sizes[hash] = size
+        if fingerprint is not None:  # file was read, remember its stat
+            fp_path, stat, old = fingerprint
+            fingerprint = (fp_path, stat, hash, old)
+            # a process worker only added its new blobs to its own copy of the index
+            remember_cached_blobs(chunks or [(hash, size)], blobs)
+        writer.put(
+            dict(name=filename, path=path, hash=hash, size=raw_size, dict_id=dict_id),
+            fingerprint,
+            chunks,
+            blobs,
+        )
 
-    backup_info = Backup.insert_new(
-        backup_uuid, create_time, total_size, message)
+    try:
+        if world is None:
+            world = iter_world_stats(*src_dirs, src_path=src_path, config=config)
+        for path, filename, file, stat in world:
+            fp_path = os.path.join(path, filename)
+            seen_paths.add(fp_path)
+            old = fingerprints.get(fp_path)
+            size = None
+            if old is not None and old[1:4] == stat and not config.paranoid_backup:
+                hash = old[4]
+                size = get_stored_size(hash)  # None if removed from cache since
+            if size is None:
+                dict_id = None
+                if stat[0] <= DICT_MAX_FILE_SIZE:
+                    dict_id = dicts.get(get_file_class(path, filename))
+                pending.append((path, filename, (fp_path, stat, old), executor.submit(cache_file, file, dict_id)))
+            else:
+                skipped_count += 1
+                pending.append((path, filename, None, (size, hash, None, stat[0], blob_dicts.get(hash), [])))
+            while len(pending) >= window:
+                collect()
+        while pending:
+            collect()
+    except BaseException:
+        writer.close(commit=False)
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        pack_reader.close()
+
+    backup_info = None
+
+    def finalize():
+        nonlocal backup_info
+        remove_fingerprints(
+            [old[0] for fp_path, old in fingerprints.items() if fp_path not in seen_paths]
+        )
+        stored_size, new_size, unique_size = add_backup_refs(backup_uuid, stored_sizes)
+        backup_info = writer.backup
+        backup_info.update_sizes(
+            total_size,
+            logical_size=logical_size, stored_size=stored_size, new_size=new_size, unique_size=unique_size,
+        )
+        add_stat("backup_count", 1)
+
+    writer.close(finalize=finalize)
+    backup_info.file_count = file_count
+    backup_info.skipped_count = skipped_count
     return backup_info
 
 
 def restore_backup_util(
-    backup_uuid: str, dst_dir: str
+    backup_uuid: str, dst_dir: str, progress: Optional[Callable] = None
 ) -> Backup:
     backup_info = Backup.from_row(get_backup_row(backup_uuid))
 
     files = get_backup_files(backup_uuid)
+    chunks = get_backup_chunks(backup_uuid)
+    restore_files(files, chunks, dst_dir, progress)
+
+    return backup_info
+
+
+def restore_files(files: list, chunks: dict, dst_dir: str, progress: Optional[Callable] = None):
+    """
+    decompress files with a thread pool, each directory is created once beforehand.
+    progress is called every few seconds with (files done, total files, bytes written, seconds elapsed)
+    """
+    for path in {file.path for file in files}:
+        os.makedirs(os.path.join(dst_dir, path), exist_ok=True)
+    get_packed_blobs()
+    get_cached_blobs()
+
+    workers = get_worker_count(config.restore_workers)
+    start_time = last_report = time.time()
+    done = written = 0
+    pending = deque()
+    with get_executor(workers) as executor:
+        try:
+            # keep several files queued per worker so that reads of the cache run ahead
+            for file in files:
+                pending.append(executor.submit(restore_file, file, chunks, dst_dir))
+                while pending and (len(pending) >= workers * 4 or pending[0].done()):
+                    written += pending.popleft().result()
+                    done += 1
+                    if progress is not None and time.time() - last_report >= PROGRESS_INTERVAL:
+                        last_report = time.time()
+                        progress(done, len(files), written, last_report - start_time)
+            while pending:
+                written += pending.popleft().result()
+                done += 1
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            pack_reader.close()
+    if progress is not None:
+        progress(done, len(files), written, time.time() - start_time)
+
+
+def restore_file(file, chunks: dict, dst_dir: str) -> int:
+    """restore a file into an existing directory, returns its size"""
+    # server/world/level.dat
+    dst_file = os.path.join(dst_dir, file.path, file.name)
+
+    if file.hash in chunks:
+        with open(dst_file, "wb") as fdst:
+            for chunk_hash in chunks[file.hash]:
+                read_blob(chunk_hash, fdst)
+            return fdst.tell()
+    location = get_packed_blobs().get(file.hash)
+    if location is not None:
+        with open(dst_file, "wb") as fdst:
+            return fdst.write(read_packed(location))
+    blob_file = get_blob_file(file.hash)
+    if blob_file is None:
+        return 0
+    src_file, compressed = blob_file
+    fsrc = open(src_file, "rb")  # md5.zst
+    if not compressed:
+        with fsrc, open(dst_file, "wb") as fdst:
+            copyfileobj(fsrc, fdst, RESTORE_READ_SIZE)
+            return fdst.tell()
+    with fsrc, open(dst_file, "wb") as fdst:
+        pyzstd.decompress_stream(
+            fsrc, fdst, zstd_dict=read_frame_dict(fsrc),
+            option=DECOMPRESS_OPTION, read_size=RESTORE_READ_SIZE,
+        )
+        return fdst.tell()
 
-    for file in files:
-        src_file = get_cached_file(file.hash)  # md5
-        zst_src = src_file + ZST_EXT  # md5.zst
 
-        fin_dst_dir = os.path.join(dst_dir, file.path)  # server/world
-        os.makedirs(fin_dst_dir, exist_ok=True)
-        # server/world/level.dat
-        dst_file = os.path.join(fin_dst_dir, file.name)
+def get_file_hash(file: str) -> str:
+    with open(file, "rb") as fsrc:
+        return get_stream_hash(fsrc)
 
-        if os.path.exists(zst_src):
-            with open(zst_src, "rb") as fsrc:
-                with open(dst_file, "wb") as fdst:
-                    pyzstd.decompress_stream(fsrc, fdst)
-        elif os.path.exists(src_file):
-            copyfile(src_file, dst_file)
 
+def restore_changed_util(
+    backup_uuid: str,
+    *src_dirs: str,
+    src_path: str,
+    temp_dir: str = TEMP_DIR,
+    progress: Optional[Callable] = None,
+) -> Backup:
+    """
+    restore only the files that differ from the backup and delete the ones it does not have,
+    replaced files are moved to temp_dir and moved back if anything goes wrong
+    """
+    backup_info = Backup.from_row(get_backup_row(backup_uuid))
+    target = {os.path.join(file.path, file.name): file for file in get_backup_files(backup_uuid)}
+    fingerprints = load_fingerprints()
+
+    # hash the live world, files with an unchanged stat already have one
+    extra, unknown, changed = [], [], []
+    seen_paths = set()
+    for path, filename in iter_world_files(*src_dirs, src_path=src_path, config=config):
+        rel_path = os.path.join(path, filename)
+        seen_paths.add(rel_path)
+        file = target.get(rel_path)
+        if file is None:
+            extra.append(rel_path)
+            continue
+        old = fingerprints.get(rel_path)
+        stat = get_stat_fingerprint(os.stat(os.path.join(src_path, rel_path)))
+        if old is None or old[1:4] != stat or config.paranoid_backup:
+            unknown.append(rel_path)
+        elif old[4] != file.hash:
+            changed.append(rel_path)
+    workers = get_worker_count(config.backup_workers)
+    with get_executor(workers, config.backup_worker_type) as executor:
+        hashes = executor.map(get_file_hash, [os.path.join(src_path, rel_path) for rel_path in unknown])
+        changed.extend(rel_path for rel_path, hash in zip(unknown, hashes) if hash != target[rel_path].hash)
+    missing = [rel_path for rel_path in target if rel_path not in seen_paths]
+
+    moved, written = [], []
+    try:
+        for rel_path in changed + extra:
+            dst_file = os.path.join(temp_dir, rel_path)
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            move(os.path.join(src_path, rel_path), dst_file)
+            moved.append(rel_path)
+        written = changed + missing
+        restore_files(
+            [target[rel_path] for rel_path in written],
+            get_backup_chunks(backup_uuid),
+            src_path,
+            progress,
+        )
+    except BaseException:
+        for rel_path in written:
+            if os.path.exists(os.path.join(src_path, rel_path)):
+                os.remove(os.path.join(src_path, rel_path))
+        for rel_path in moved:
+            move(os.path.join(temp_dir, rel_path), os.path.join(src_path, rel_path))
+        raise
+    for src_dir in src_dirs:
+        remove_empty_dirs(os.path.join(src_path, src_dir))
+
+    # the restored files are known, the next backup does not have to read them
+    new_fingerprints, changed_fingerprints = [], []
+    for rel_path in written:
+        size, mtime_ns, inode = get_stat_fingerprint(os.stat(os.path.join(src_path, rel_path)))
+        hash = target[rel_path].hash
+        if rel_path in fingerprints:
+            changed_fingerprints.append((size, mtime_ns, inode, hash, fingerprints[rel_path][0]))
+        else:
+            new_fingerprints.append(dict(path=rel_path, size=size, mtime_ns=mtime_ns, inode=inode, hash=hash))
+    bulk_insert("fingerprints", new_fingerprints)
+    bulk_update("fingerprints", ["size", "mtime_ns", "inode", "hash"], changed_fingerprints)
+    remove_fingerprints([fingerprints[rel_path][0] for rel_path in extra if rel_path in fingerprints])
+    database.commit()
+
+    backup_info.restored_count = len(written)
+    backup_info.removed_count = len(extra)
     return backup_info
 
 
+def remove_empty_dirs(path: str):
+    for root, dirs, files in os.walk(path, topdown=False):
+        if root != path and not os.listdir(root):
+            os.rmdir(root)
+
+
+def get_stat(name: str) -> Optional[int]:
+    rows = database.executesql("SELECT value FROM stats WHERE name = ?;", placeholders=[name])
+    return rows[0][0] if rows else None
+
+
+def set_stat(name: str, value: int):
+    database.executesql(
+        "INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?);", placeholders=[name, value]
+    )
+
+
+def add_stat(name: str, delta: int):
+    database.executesql("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0);", placeholders=[name])
+    database.executesql("UPDATE stats SET value = value + ? WHERE name = ?;", placeholders=[delta, name])
+
+
+def collect_owners(backup_filter: str, placeholders: list = (), hash_table: Optional[str] = None):
+    """
+    fill temp table owners with (blob hash, backup uuid) of the files of the backups matching backup_filter,
+    a file stored in chunks uses each of its chunks. only blobs in hash_table if given
+    """
+    database.executesql(
+        "CREATE TEMP TABLE IF NOT EXISTS owners (hash TEXT, uuid TEXT, PRIMARY KEY (hash, uuid));"
+    )
+    database.executesql("DELETE FROM owners;")
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS owned (hash TEXT, uuid TEXT);")  # files of the backups
+    database.executesql("DELETE FROM owned;")
+    file_filter = chunk_filter = ""
+    if hash_table is None:
+        database.executesql(
+            manifest_entries(backup_filter) + "INSERT INTO owned SELECT printf('%016x', entries.hash), backups.uuid "
+            "FROM entries JOIN backups ON backups.id = entries.backup_id;",
+            placeholders=list(placeholders),
+        )
+    else:  # only the files with these blobs or chunks of them
+        database.executesql(
+            manifest_reach(
+                f"manifest.hash IN (SELECT hash_id(hash) FROM {hash_table} UNION "
+                f"SELECT hash_id(hash) FROM chunks WHERE chunk_hash IN (SELECT hash FROM {hash_table}))"
+            ) + "INSERT INTO owned SELECT printf('%016x', reach.hash), backups.uuid "
+            f"FROM reach JOIN backups ON backups.id = reach.backup_id WHERE {backup_filter};",
+            placeholders=list(placeholders),
+        )
+        file_filter = f" AND owned.hash IN (SELECT hash FROM {hash_table})"
+        chunk_filter = f" AND chunks.chunk_hash IN (SELECT hash FROM {hash_table})"
+    database.executesql(
+        "INSERT OR IGNORE INTO owners SELECT hash, uuid FROM owned "
+        f"WHERE NOT EXISTS (SELECT 1 FROM chunks WHERE chunks.hash = owned.hash){file_filter};"
+    )
+    database.executesql(
+        "INSERT OR IGNORE INTO owners SELECT chunks.chunk_hash, owned.uuid "
+        f"FROM owned JOIN chunks ON chunks.hash = owned.hash WHERE 1{chunk_filter};"
+    )
+
+
+def move_unique_size(sign: int):
+    """add (sign 1) or take (sign -1) the size of the blobs in temp table shared to their owners"""
+    database.executesql(
+        f"UPDATE backups SET unique_size = unique_size + {sign} * (SELECT SUM(shared.size) FROM owners "
+        "JOIN shared ON shared.hash = owners.hash WHERE owners.uuid = backups.uuid) "
+        "WHERE uuid IN (SELECT uuid FROM owners);"
+    )
+
+
+def create_shared_table():
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS shared (hash TEXT PRIMARY KEY, size INTEGER);")
+    database.executesql("DELETE FROM shared;")
+
+
+def add_backup_refs(backup_uuid: str, stored_sizes: dict) -> tuple:
+    """
+    count the blobs of a new backup in blobs table and stats,
+    stored_sizes gives the size of blobs not known yet. returns (stored size, new size, unique size) of the backup
+    """
+    collect_owners("backups.uuid = ?", [backup_uuid])
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS refs (hash TEXT PRIMARY KEY, size INTEGER);")
+    database.executesql("DELETE FROM refs;")
+    database.executesql(  # a chunk's size is in chunks table, a known blob's in blobs table
+        "INSERT INTO refs SELECT owners.hash, COALESCE("
+        "(SELECT size FROM blobs WHERE blobs.hash = owners.hash), "
+        "(SELECT size FROM chunks WHERE chunks.chunk_hash = owners.hash LIMIT 1)) FROM owners;"
+    )
+    database._adapter.connection.executemany(
+        "UPDATE refs SET size = ? WHERE hash = ? AND size IS NULL;",
+        [(size, hash) for hash, size in stored_sizes.items()],
+    )
+    new_count, new_size = database.executesql(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM refs WHERE hash NOT IN (SELECT hash FROM blobs);"
+    )[0]
+    database.executesql("INSERT OR IGNORE INTO blobs (hash, size, refs) SELECT hash, COALESCE(size, 0), 0 FROM refs;")
+    database.executesql("UPDATE blobs SET refs = refs + 1 WHERE hash IN (SELECT hash FROM refs);")
+    add_stat("blob_count", new_count)
+    add_stat("cache_size", new_size)
+
+    # blobs used by a second backup now were unique to the first one
+    create_shared_table()
+    database.executesql(
+        "INSERT INTO shared SELECT hash, size FROM blobs WHERE refs = 2 AND hash IN (SELECT hash FROM refs);"
+    )
+    collect_owners("backups.uuid != ?", [backup_uuid], hash_table="shared")
+    move_unique_size(-1)
+    stored_size, unique_size = database.executesql(
+        "SELECT COALESCE(SUM(size), 0), COALESCE(SUM(CASE WHEN refs = 1 THEN size ELSE 0 END), 0) "
+        "FROM blobs WHERE hash IN (SELECT hash FROM refs);"
+    )[0]
+    return stored_size, new_size, unique_size
+
+
+def remove_backup_refs(backup_uuids: list):
+    """uncount the blobs of backups about to be removed from blobs table and stats"""
+    marks = ", ".join("?" * len(backup_uuids))
+    collect_owners(f"backups.uuid IN ({marks})", backup_uuids)
+    database.executesql(
+        "UPDATE blobs SET refs = refs - (SELECT COUNT(*) FROM owners WHERE owners.hash = blobs.hash) "
+        "WHERE hash IN (SELECT hash FROM owners);"
+    )
+    create_shared_table()
+    database.executesql(
+        "INSERT INTO shared SELECT hash, size FROM blobs WHERE refs = 1 AND hash IN (SELECT hash FROM owners);"
+    )
+    count, size = database.executesql("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs WHERE refs <= 0;")[0]
+    database.executesql("DELETE FROM blobs WHERE refs <= 0;")
+    add_stat("blob_count", -count)
+    add_stat("cache_size", -size)
+
+    # blobs left with a single backup are unique to it now
+    collect_owners(f"backups.uuid NOT IN ({marks})", backup_uuids, hash_table="shared")
+    move_unique_size(1)
+
+
+def rebuild_stats_util():
+    """count every blob from scratch, for databases of older versions and after gc"""
+    collect_owners("1")
+    database.executesql("DELETE FROM blobs;")
+    database.executesql(
+        "INSERT INTO blobs (hash, size, refs) SELECT hash, "
+        "(SELECT size FROM chunks WHERE chunks.chunk_hash = owners.hash LIMIT 1), COUNT(*) "
+        "FROM owners GROUP BY hash;"
+    )
+    get_packed_blobs()
+    bulk_update("blobs", ["size"], [
+        (get_cached_size(hash) or 0, id)
+        for id, hash in database.executesql("SELECT id, hash FROM blobs WHERE size IS NULL;")
+    ])
+    database.executesql(
+        "UPDATE backups SET "
+        "stored_size = (SELECT COALESCE(SUM(blobs.size), 0) FROM owners JOIN blobs ON blobs.hash = owners.hash "
+        "WHERE owners.uuid = backups.uuid), "
+        "unique_size = (SELECT COALESCE(SUM(blobs.size), 0) FROM owners JOIN blobs ON blobs.hash = owners.hash "
+        "WHERE owners.uuid = backups.uuid AND blobs.refs = 1);"
+    )
+    # only known when the backup was created, estimated for backups of older versions
+    for backup_id, in database.executesql("SELECT id FROM backups WHERE logical_size IS NULL;"):
+        database.executesql(
+            manifest_entries("id = ?") + "UPDATE backups SET logical_size = (SELECT SUM(size) FROM entries) "
+            "WHERE id = ?;",
+            placeholders=[backup_id, backup_id],
+        )
+    database.executesql(  # bytes of the blobs it is the oldest user of
+        "UPDATE backups SET new_size = (SELECT COALESCE(SUM(blobs.size), 0) FROM ("
+        "SELECT owners.hash, owners.uuid, MIN(backups.time) FROM owners "
+        "JOIN backups ON backups.uuid = owners.uuid GROUP BY owners.hash"
+        ") AS first JOIN blobs ON blobs.hash = first.hash WHERE first.uuid = backups.uuid) "
+        "WHERE new_size IS NULL;"
+    )
+    count, size = database.executesql("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs;")[0]
+    set_stat("blob_count", count)
+    set_stat("cache_size", size)
+    set_stat("backup_count", database(database.backups).count())
+    database.commit()
+
+
+def get_freed_size(backup_uuids: list) -> int:
+    """bytes given back by removing all these backups, more than the sum of their unique sizes"""
+    if len(backup_uuids) == 1:
+        return database(database.backups.uuid == backup_uuids[0]).select(
+            database.backups.unique_size
+        ).first().unique_size or 0
+    marks = ", ".join("?" * len(backup_uuids))
+    collect_owners(f"backups.uuid IN ({marks})", backup_uuids)
+    return database.executesql(
+        "SELECT COALESCE(SUM(blobs.size), 0) FROM blobs WHERE blobs.hash IN (SELECT hash FROM owners) "
+        "AND blobs.refs = (SELECT COUNT(*) FROM owners WHERE owners.hash = blobs.hash);"
+    )[0][0]
+
+
 def remove_backup_util(backup_uuid: str):
-    files = get_backup_files(backup_uuid)
-    for file in files:
-        hash = file.hash
-        file.delete_record()
-        if database(database.files.hash == hash).isempty():  # remove file record if useless
-            path = get_cached_file(hash)
-            zst_path = path + ZST_EXT
-            if os.path.exists(zst_path):
-                os.remove(zst_path)
-            elif os.path.exists(path):
-                os.remove(path)
+    remove_backups_util([backup_uuid])
+
+
+def remove_backups_util(backup_uuids: list):
+    """remove backups, then unlink the blobs nothing refers to any more"""
+    parents = {row.id: row.parent_id for row in get_backups(database.backups.uuid.belongs(backup_uuids))}
+    backup_ids = list(parents)
+    marks = ", ".join("?" * len(backup_ids))
+    remove_backup_refs(backup_uuids)
+    # a backup built on a removed one records the changes from its nearest remaining parent instead
+    for child in get_backups(database.backups.parent_id.belongs(backup_ids) & ~database.backups.id.belongs(backup_ids)):
+        parent_id = child.parent_id
+        while parent_id in parents:
+            parent_id = parents[parent_id]
+        write_delta(child.id, parent_id)
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS removed (hash INTEGER PRIMARY KEY);")
+    database.executesql("DELETE FROM removed;")
+    database.executesql(
+        f"INSERT OR IGNORE INTO removed SELECT hash FROM manifest WHERE backup_id IN ({marks}) AND hash IS NOT NULL;",
+        placeholders=backup_ids,
+    )
+    database(database.manifest.backup_id.belongs(backup_ids)).delete()
+    removed = database(database.backups.id.belongs(backup_ids)).delete() # remove backup record
+    add_stat("backup_count", -removed)
+    orphans = [row[0] for row in database.executesql(  # hashes only these backups referred to
+        "SELECT printf('%016x', hash) FROM removed "
+        "WHERE NOT EXISTS (SELECT 1 FROM manifest WHERE manifest.hash = removed.hash);"
+    )]
+    unused = sweep_hashes(orphans)
+    database.executesql("DELETE FROM packed WHERE hash IN (SELECT hash FROM gc);")
     database.commit()
-    database(database.backups.uuid == backup_uuid).delete() # remove backup record
+    for hash in unused:
+        remove_blob(hash)
+
+
+def sweep_hashes(orphans: list) -> list:
+    """
+    drop chunk records of file hashes no longer in manifest,
+    returns the blobs among them and their chunks that nothing refers to
+    """
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS gc (hash TEXT PRIMARY KEY);")
+    database.executesql("DELETE FROM gc;")
+    database._adapter.connection.executemany(
+        "INSERT OR IGNORE INTO gc VALUES (?);", [(hash,) for hash in orphans]
+    )
+    database.executesql(
+        "INSERT OR IGNORE INTO gc SELECT chunk_hash FROM chunks WHERE hash IN (SELECT hash FROM gc);"
+    )
+    database.executesql("DELETE FROM chunks WHERE hash IN (SELECT hash FROM gc);")
+    database.executesql(
+        "DELETE FROM gc WHERE EXISTS (SELECT 1 FROM manifest WHERE manifest.hash = hash_id(gc.hash)) "
+        "OR EXISTS (SELECT 1 FROM chunks WHERE chunks.chunk_hash = gc.hash);"
+    )
+    return [row[0] for row in database.executesql("SELECT hash FROM gc;")]
+
+
+def gc_util() -> tuple:
+    """
+    drop records left by interrupted operations and unlink every cached blob
+    that no backup refers to, returns (blob count, bytes freed)
+    """
+    database.executesql(
+        "DELETE FROM manifest WHERE NOT EXISTS (SELECT 1 FROM backups WHERE backups.id = manifest.backup_id);"
+    )
+    database.executesql("DELETE FROM paths WHERE id NOT IN (SELECT path_id FROM manifest);")
+    database.executesql(
+        "DELETE FROM chunks WHERE NOT EXISTS (SELECT 1 FROM manifest WHERE manifest.hash = hash_id(chunks.hash));"
+    )
+    database.executesql(
+        "DELETE FROM packed WHERE NOT EXISTS (SELECT 1 FROM manifest WHERE manifest.hash = hash_id(packed.hash)) "
+        "AND NOT EXISTS (SELECT 1 FROM chunks WHERE chunks.chunk_hash = packed.hash);"
+    )
+    database.commit()
+    forget_packed_blobs()
+    forget_cached_blobs()
+    referenced = {row[0] for row in database.executesql(
+        "SELECT DISTINCT printf('%016x', hash) FROM manifest WHERE hash IS NOT NULL;"
+    )}
+    referenced.update(row[0] for row in database.executesql("SELECT DISTINCT chunk_hash FROM chunks;"))
+
+    rebuild_stats_util()
+
+    count = freed = 0
+    cache_dir = os.path.join(config.backup_data_path, CACHE_DIR)
+    for prefix in os.listdir(cache_dir):
+        if os.path.isfile(os.path.join(cache_dir, prefix)):  # unfinished new blob of write_new_blob
+            freed += os.path.getsize(os.path.join(cache_dir, prefix))
+            os.remove(os.path.join(cache_dir, prefix))
+            count += 1
+            continue
+        with os.scandir(os.path.join(cache_dir, prefix)) as entries:
+            for entry in entries:
+                hash = prefix + entry.name
+                if hash.endswith(ZST_EXT):
+                    hash = hash[:-len(ZST_EXT)]
+                if entry.is_file() and hash not in referenced:  # also unfinished *.tmp files
+                    freed += entry.stat().st_size
+                    os.remove(entry.path)
+                    count += 1
+    forget_cached_blobs()  # listed by rebuild_stats_util before the unused files were removed
+    return count, freed
+
+
+def repack_util() -> tuple:
+    """
+    copy the blobs still in use out of packs that are mostly removed ones, then delete those packs.
+    returns (packs rewritten, bytes freed)
+    """
+    pack_dir = os.path.join(config.backup_data_path, PACK_DIR)
+    used = dict(database.executesql("SELECT pack, SUM(length) FROM packed GROUP BY pack;"))
+    packs = {
+        pack: size for pack, size in list_packs(pack_dir).items()
+        if used.get(pack, 0) < size * (1 - REPACK_GARBAGE_RATIO)
+    }
+    writer = PackWriter(pack_dir, config.pack_size, new_pack=True)  # never append to a pack being repacked
+    moved, moved_size = [], 0
+    try:
+        for pack in sorted(packs):
+            for id, start, length in database.executesql(
+                "SELECT id, start, length FROM packed WHERE pack = ? ORDER BY start;", placeholders=[pack]
+            ):
+                new_pack, new_start = writer.append(pack_reader.read(pack, start, length))
+                moved.append((new_pack, new_start, id))
+                moved_size += length
+    finally:
+        writer.close()
+        pack_reader.close()
+    bulk_update("packed", ["pack", "start"], moved)
     database.commit()
+    forget_packed_blobs()
+    for pack in packs:
+        os.remove(get_pack_file(pack_dir, pack))
+    return len(packs), sum(packs.values()) - moved_size
+
+
+class RateLimiter:
+    """spaces out the reads of several threads so that together they read at most rate bytes per second"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size: int):
+        """wait until size more bytes may be read, 0 or less for no limit"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def verify_blob(hash: str, reader: PackReader, limiter: RateLimiter) -> Optional[tuple]:
+    """
+    read a stored blob back and hash its original content,
+    returns (bytes read, dictionary named in its frame) or None if it is corrupt
+    """
+    digest = xxhash.xxh3_64()
+    frame_dict_id = None
+    try:
+        location = get_packed_blobs().get(hash)
+        if location is not None:
+            pack, start, length, compressed = location
+            limiter.consume(length)
+            data = reader.read(pack, start, length)
+            if compressed:
+                frame_dict_id = get_frame_dict_id(data[:18])
+                data = pyzstd.decompress(data, get_zstd_dict(frame_dict_id), DECOMPRESS_OPTION)
+            digest.update(data)
+            size = length
+        else:
+            blob_file = get_blob_file(hash)
+            if blob_file is None:
+                return None
+            file, compressed = blob_file
+            with open(file, "rb") as fsrc:
+                if compressed:
+                    def update(total_input, total_output, read_data, write_data):
+                        limiter.consume(len(read_data))
+                        digest.update(write_data)
+
+                    frame_dict_id = get_frame_dict_id(fsrc.read(18))
+                    fsrc.seek(0)
+                    pyzstd.decompress_stream(
+                        fsrc, None, zstd_dict=get_zstd_dict(frame_dict_id), option=DECOMPRESS_OPTION,
+                        read_size=RESTORE_READ_SIZE, callback=update,
+                    )
+                else:
+                    for data in iter(lambda: fsrc.read(RESTORE_READ_SIZE), b""):
+                        limiter.consume(len(data))
+                        digest.update(data)
+                size = fsrc.tell()
+    except (OSError, ValueError, pyzstd.ZstdError):  # missing, truncated or not zstd at all
+        return None
+    return (size, frame_dict_id) if digest.hexdigest() == hash else None
+
+
+def get_verify_state_file() -> str:
+    return os.path.join(config.backup_data_path, VERIFY_STATE_FILE)
+
+
+def save_verify_state(state: dict):
+    with open(get_verify_state_file(), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def verify_util(
+    backup_uuid: Optional[str] = None,
+    progress: Optional[Callable] = None,
+    aborted: Callable[[], bool] = lambda: False,
+) -> Optional[tuple]:
+    """
+    read the blobs of a backup, or every blob if None, back with a thread pool and check their hashes,
+    at most verify_rate_limit MB/s. a scrub of the same backups stopped before goes on from verify.json.
+    progress is called every few seconds with (blobs done, total blobs, bytes read, seconds elapsed).
+    returns (blob count, corrupt hashes, uuids of the backups using them, hashes of intact blobs
+    compressed with another dictionary than their manifest rows name), None if aborted
+    """
+    target = backup_uuid or "all"
+    # blobs are checked in the order of their hash
+    state = dict(target=target, position="", corrupt=[], mismatched=[])
+    try:
+        with open(get_verify_state_file(), "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["target"] == target:
+            state = dict(
+                target=target, position=saved["position"], corrupt=saved["corrupt"],
+                mismatched=saved.get("mismatched", []),
+            )
+    except (OSError, ValueError, KeyError):
+        pass
+    if backup_uuid is None:
+        hashes = [row[0] for row in database.executesql("SELECT hash FROM blobs ORDER BY hash;")]
+        row_filter = ""
+    else:
+        collect_owners("backups.uuid = ?", [backup_uuid])
+        hashes = [row[0] for row in database.executesql("SELECT DISTINCT hash FROM owners ORDER BY hash;")]
+        row_filter = " AND hash IN (SELECT hash_id(hash) FROM owners)"
+    # hash -> dictionaries the manifest rows of the blob name, only metadata: reads take the one in the frame
+    blob_dicts = defaultdict(tuple)
+    for hash, dict_id in database.executesql(
+        f"SELECT DISTINCT printf('%016x', hash), dict_id FROM manifest WHERE hash IS NOT NULL{row_filter};"
+    ):
+        blob_dicts[hash] += (dict_id,)
+    database.commit()  # do not hold a snapshot of the database for the whole scrub
+    total = len(hashes)
+    hashes = [hash for hash in hashes if hash > state["position"]]
+    get_packed_blobs()
+    get_cached_blobs()
+
+    # backups and gc go on meanwhile, the shared pack maps may be closed by them at any time
+    reader = PackReader(os.path.join(config.backup_data_path, PACK_DIR))
+    limiter = RateLimiter(config.verify_rate_limit * 2**20)
+    workers = get_worker_count(config.verify_workers)
+    start_time = last_report = time.time()
+    done, read = total - len(hashes), 0
+    stopped = False
+    pending = deque()
+
+    def collect():
+        nonlocal done, read, last_report
+        hash, future = pending.popleft()
+        result = future.result()
+        if result is None:
+            state["corrupt"].append(hash)
+        else:
+            size, frame_dict_id = result
+            read += size
+            if any(dict_id != frame_dict_id for dict_id in blob_dicts[hash]):
+                state["mismatched"].append(hash)
+        done += 1
+        state["position"] = hash
+        if time.time() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.time()
+            save_verify_state(state)
+            if progress is not None:
+                progress(done, total, read, last_report - start_time)
+
+    with get_executor(workers) as executor:
+        try:
+            for hash in hashes:
+                stopped = aborted()
+                if stopped:
+                    break
+                pending.append((hash, executor.submit(verify_blob, hash, reader, limiter)))
+                while len(pending) >= workers * 4:
+                    collect()
+            while pending:
+                collect()
+        except BaseException:
+            save_verify_state(state)
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            reader.close()
+    if stopped:
+        save_verify_state(state)
+        return None
+    if progress is not None:
+        progress(done, total, read, time.time() - start_time)
+
+    corrupt, uuids = [], []
+    if state["corrupt"]:
+        with operation_lock:  # blobs removed or moved by an operation since are not corrupt
+            still = {
+                row[0] for row in database.executesql(
+                    "SELECT hash FROM blobs WHERE hash IN ({});".format(", ".join("?" * len(state["corrupt"]))),
+                    placeholders=state["corrupt"],
+                )
+            }
+            corrupt = [
+                hash for hash in state["corrupt"]
+                if hash in still and verify_blob(hash, reader, RateLimiter(0)) is None
+            ]
+            reader.close()
+            database.executesql("CREATE TEMP TABLE IF NOT EXISTS corrupt (hash TEXT PRIMARY KEY);")
+            database.executesql("DELETE FROM corrupt;")
+            database._adapter.connection.executemany(
+                "INSERT OR IGNORE INTO corrupt VALUES (?);", [(hash,) for hash in corrupt]
+            )
+            collect_owners("1", hash_table="corrupt")
+            uuids = [row[0] for row in database.executesql(
+                "SELECT DISTINCT backups.uuid FROM owners JOIN backups ON backups.uuid = owners.uuid "
+                "ORDER BY backups.time DESC;"
+            )]
+            database.commit()
+    try:
+        os.remove(get_verify_state_file())
+    except FileNotFoundError:
+        pass
+    return total, corrupt, uuids, state["mismatched"]
+
+
+def train_dicts_util(backup_uuid: str, retrain: bool = False) -> list:
+    """
+    train a zstd dictionary per file class from the small files of a backup,
+    only for classes without one unless retrain. returns [(file class, version, sample count)]
+    """
+    versions = dict(database.executesql(
+        "SELECT file_class, MAX(version) FROM dictionaries GROUP BY file_class;"
+    ))
+    missing = {file_class for file_class in DICT_CLASSES if retrain or file_class not in versions}
+    if not missing:  # called after every backup, nothing is read once every class has a dictionary
+        return []
+    # paths of the classes in any backup, a class with too few of them can not be trained from this one either
+    class_paths = defaultdict(list)
+    extensions = sorted({DICT_CLASSES[file_class][1] for file_class in missing})
+    for path_id, path, name in database.executesql(
+        "SELECT id, path, name FROM paths WHERE {};".format(" OR ".join(["name LIKE ?"] * len(extensions))),
+        placeholders=["%" + extension for extension in extensions],
+    ):
+        file_class = get_file_class(path, name)
+        if file_class in missing:
+            class_paths[file_class].append((path_id, path, name))
+    path_classes = {
+        path_id: (file_class, path, name)
+        for file_class, paths in class_paths.items() if len(paths) >= DICT_MIN_SAMPLES
+        for path_id, path, name in paths
+    }
+    if not path_classes:
+        return []
+
+    database.executesql("CREATE TEMP TABLE IF NOT EXISTS samples (path_id INTEGER PRIMARY KEY);")
+    database.executesql("DELETE FROM samples;")
+    database._adapter.connection.executemany(
+        "INSERT INTO samples VALUES (?);", [(path_id,) for path_id in path_classes]
+    )
+    samples = {}  # file class -> {hash: file}
+    for path_id, hash, size, dict_id in database.executesql(  # small files of these classes not stored in chunks
+        manifest_entries("uuid = ?") + "SELECT path_id, printf('%016x', hash), size, dict_id FROM entries "
+        "WHERE path_id IN (SELECT path_id FROM samples) AND size <= ? "
+        "AND printf('%016x', hash) NOT IN (SELECT hash FROM chunks);",
+        placeholders=[backup_uuid, DICT_MAX_FILE_SIZE],
+    ):
+        file_class, path, name = path_classes[path_id]
+        samples.setdefault(file_class, {})[hash] = BackupFile(path, name, hash, size, dict_id)
+
+    trained = []
+    os.makedirs(os.path.join(config.backup_data_path, DICT_DIR), exist_ok=True)
+    for file_class, files in sorted(samples.items()):
+        if len(files) < DICT_MIN_SAMPLES:
+            continue
+        data = []
+        for file in files.values():
+            with open_backup_file(file, {}) as fsrc:
+                data.append(fsrc.read())
+        pack_reader.close()
+        try:
+            zstd_dict = pyzstd.train_dict(data, config.dict_size)
+        except pyzstd.ZstdError:  # samples too small or too similar
+            continue
+        dict_file = get_dict_file(zstd_dict.dict_id)
+        with open(get_temp_file(dict_file), "wb") as fdict:
+            fdict.write(zstd_dict.dict_content)
+        os.replace(fdict.name, dict_file)
+        version = versions.get(file_class, 0) + 1
+        database.dictionaries.insert(
+            dict_id=zstd_dict.dict_id, file_class=file_class, version=version, time=int(time.time())
+        )
+        trained.append((file_class, version, len(files)))
+    database.commit()
+    return trained
 
 
 def auto_remove_util(limit: int) -> list:
-    # get unlocked backup by ~time
-    all_backup_info = get_backups((database.backups.locked == False) | (database.backups.locked == None), orderby=~database.backups.time)
-    count = len(all_backup_info)
+    # get unlocked backup by ~time, skipping the newest ones to keep
+    unlocked = (database.backups.locked == False) | (database.backups.locked == None)
+    count = database(unlocked).count()
     removed_uuids = []
     if count > limit:
-        for backup_info in all_backup_info[limit:]: # remove oldest backups
-            remove_backup_util(backup_info.uuid)
-            removed_uuids.append(backup_info.uuid)
+        removed_uuids = [backup_info.uuid for backup_info in get_backup_page(limit, count - limit, unlocked)] # remove oldest backups
+        remove_backups_util(removed_uuids)
     return removed_uuids
 
 
@@ -403,20 +2017,16 @@ def export_backup_util(
     export_format: ExportFormat,
     compress_level: int = 1,
 ):
-    dst_dir = os.path.join(output_dir, backup_uuid)
-    if os.path.isdir(dst_dir):
-        rmtree(dst_dir)
-    restore_backup_util(  # plain export first
-        backup_uuid=backup_uuid,
-        dst_dir=dst_dir
-    )
-    output_path = dst_dir
-    if export_format != ExportFormat.plain:  # pack to tar if required
-        output_path = add_to_tar(
-            backup_uuid, dst_dir, output_dir, export_format, compress_level
+    if export_format == ExportFormat.plain:
+        dst_dir = os.path.join(output_dir, backup_uuid)
+        if os.path.isdir(dst_dir):
+            rmtree(dst_dir)
+        restore_backup_util(
+            backup_uuid=backup_uuid,
+            dst_dir=dst_dir
         )
-        rmtree(dst_dir)
-    return output_path
+        return dst_dir
+    return write_tar(backup_uuid, output_dir, export_format, compress_level)
 
 
 def get_export_file_name(backup_format: ExportFormat, backup_uuid: str):
@@ -425,14 +2035,11 @@ def get_export_file_name(backup_format: ExportFormat, backup_uuid: str):
     return backup_format.get_file_name(backup_uuid)
 
 
-def add_to_tar(
-    backup_uuid: str,
-    src_dir: str,
-    dst_dir: str,
+def open_tar(
+    tar_path: str,
     export_format: ExportFormat = ExportFormat.tar,
     compress_level: int = 1,
-) -> str:
-
+) -> tarfile.TarFile:
     tar_builder = tarfile.open
     if export_format == ExportFormat.tar_gz:
         tar_mode = "w:gz"
@@ -447,13 +2054,51 @@ def add_to_tar(
     kwargs = {}
     if export_format.supports_compress_level and 1 <= compress_level <= export_format.max_level:
         kwargs["compresslevel"] = compress_level
+    if export_format == ExportFormat.tar_zst:  # level 0 is zstd's default
+        kwargs["compresslevel"] = get_zstd_option(kwargs.get("compresslevel", 0))
+    return tar_builder(tar_path, tar_mode, **kwargs)
+
+
+def write_tar(
+    backup_uuid: str,
+    dst_dir: str,
+    export_format: ExportFormat = ExportFormat.tar,
+    compress_level: int = 1,
+) -> str:
+    """stream the files of a backup from the cache into a tar, nothing is staged on disk"""
+    backup_info = Backup.from_row(get_backup_row(backup_uuid))
+    files = get_backup_files(backup_uuid)
+    chunks = get_backup_chunks(backup_uuid)
 
     if not os.path.isdir(dst_dir):
         os.makedirs(dst_dir, exist_ok=True)
     tar_path = os.path.join(
         dst_dir, get_export_file_name(export_format, backup_uuid))
 
-    with tar_builder(tar_path, tar_mode, **kwargs) as f:
-        f.add(src_dir, arcname=backup_uuid)
+    dirs = {""}  # tar member names always use "/", whatever os.sep is
+    for file in files:
+        path = posixpath.normpath(file.path.replace(os.sep, "/"))
+        while path not in dirs and path not in ("", "."):
+            dirs.add(path)
+            path = posixpath.dirname(path)
+
+    with open_tar(tar_path, export_format, compress_level) as tar:
+        for path in sorted(dirs):
+            info = tarfile.TarInfo(posixpath.join(backup_uuid, path).rstrip("/"))
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = backup_info.time
+            tar.addfile(info)
+        for file in files:
+            info = tarfile.TarInfo(posixpath.join(backup_uuid, file.path.replace(os.sep, "/"), file.name))
+            info.mode = 0o644
+            info.mtime = backup_info.time
+            info.size = file.size
+            if info.size is None:  # recorded before sizes were, read it once to count
+                with open_backup_file(file, chunks) as fsrc:
+                    info.size = sum(iter(lambda: len(fsrc.read(RESTORE_READ_SIZE)), 0))
+            with open_backup_file(file, chunks) as fsrc:
+                tar.addfile(info, fsrc)
+    pack_reader.close()
 
     return tar_path
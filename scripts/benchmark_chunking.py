@@ -0,0 +1,92 @@
+"""
+对比整文件存储与内容分块 (FastCDC) 存储的空间占用与耗时
+
+用法: python scripts/benchmark_chunking.py <目录> [--rounds 5] [--edit 4096] [--threshold 16777216]
+
+对目录下大于 threshold 的非区域文件，模拟 rounds 次小改动 (随机位置插入 + 末尾追加 edit 字节)，
+每次改动后分别按两种方式存入缓存，统计新增的压缩后字节数与耗时，不会修改原文件
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import time
+
+import pyzstd
+import xxhash
+
+spec = importlib.util.spec_from_file_location(  # avoid importing the plugin package without MCDR
+    "chunking",
+    os.path.join(os.path.dirname(__file__), "..", "better_backup", "chunking.py"),
+)
+chunking = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(chunking)
+
+
+def store(cache: dict, data, level: int) -> int:
+    """returns the bytes newly added to the cache"""
+    hash = xxhash.xxh3_64_hexdigest(data)
+    if hash in cache:
+        return 0
+    cache[hash] = len(pyzstd.compress(data, level)) if level else len(data)
+    return cache[hash]
+
+
+def store_whole(cache: dict, data: bytes, level: int, avg_size: int) -> int:
+    return store(cache, data, level)
+
+
+def store_chunked(cache: dict, data: bytes, level: int, avg_size: int) -> int:
+    view = memoryview(data)
+    return sum(
+        store(cache, view[start:end], level)
+        for start, end in chunking.split_cdc(view, avg_size)
+    )
+
+
+def edit(data: bytes, rnd: random.Random, size: int) -> bytes:
+    offset = rnd.randrange(len(data))
+    return data[:offset] + rnd.randbytes(size) + data[offset:] + rnd.randbytes(size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--edit", type=int, default=4096)
+    parser.add_argument("--threshold", type=int, default=16777216)
+    parser.add_argument("--avg-size", type=int, default=65536)
+    parser.add_argument("--level", type=int, default=3)
+    args = parser.parse_args()
+
+    files = []
+    for root, _, names in os.walk(args.path):
+        for name in names:
+            file = os.path.join(root, name)
+            if not name.endswith(chunking.REGION_EXTS) and os.path.getsize(file) > args.threshold:
+                files.append(file)
+    if not files:
+        print(f"no file larger than {args.threshold} bytes found")
+        return
+    print(f"{len(files)} files, {sum(map(os.path.getsize, files)) / 2**20:.1f} MiB, "
+          f"{args.rounds} rounds of {args.edit} byte edits")
+
+    print(f"{'mode':<8}{'round':>6}{'added MiB':>12}{'total MiB':>12}{'seconds':>10}")
+    for mode, func in (("whole", store_whole), ("fastcdc", store_chunked)):
+        cache = {}
+        rnd = random.Random(0)
+        versions = {file: open(file, "rb").read() for file in files}
+        total = 0
+        for round in range(args.rounds + 1):
+            if round:
+                versions = {file: edit(data, rnd, args.edit) for file, data in versions.items()}
+            start = time.perf_counter()
+            added = sum(func(cache, data, args.level, args.avg_size) for data in versions.values())
+            elapsed = time.perf_counter() - start
+            total += added
+            print(f"{mode:<8}{round:>6}{added / 2**20:>12.2f}{total / 2**20:>12.2f}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+对比不同 zstd 参数 (等级、线程数、长距离匹配、窗口大小) 的压缩速度与压缩率
+
+用法: python scripts/benchmark_zstd.py <目录> [--levels 3,10,19] [--threads 0,4] [--window-logs 0,27] [--limit 1073741824]
+
+目录下的文件按导出时的方式打包成一个 tar 流后整体压缩，输出 markdown 表格，不会修改原文件
+"""
+
+import argparse
+import importlib.util
+import io
+import itertools
+import os
+import tarfile
+import time
+
+import pyzstd
+
+spec = importlib.util.spec_from_file_location(  # avoid importing the plugin package without MCDR
+    "compression",
+    os.path.join(os.path.dirname(__file__), "..", "better_backup", "compression.py"),
+)
+compression = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(compression)
+
+
+def build_tar(path: str, limit: int) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                file = os.path.join(root, name)
+                if buffer.tell() + os.path.getsize(file) > limit:
+                    return buffer.getvalue()
+                tar.add(file, arcname=os.path.relpath(file, path))
+    return buffer.getvalue()
+
+
+def parse_ints(value: str) -> list:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--levels", type=parse_ints, default=[3, 10, 19])
+    parser.add_argument("--threads", type=parse_ints, default=[0, os.cpu_count() or 1])
+    parser.add_argument("--window-logs", type=parse_ints, default=[0, 27])
+    parser.add_argument("--limit", type=int, default=2**30, help="bytes of the directory to read at most")
+    args = parser.parse_args()
+
+    data = build_tar(args.path, args.limit)
+    print(f"{len(data) / 2**20:.1f} MiB tar of {args.path}, {os.cpu_count()} cpus\n")
+    print("| level | threads | long distance | window log | MB/s | ratio |")
+    print("|---|---|---|---|---|---|")
+    for level, threads, long_distance, window_log in itertools.product(
+        args.levels, sorted(set(args.threads)), (False, True), args.window_logs
+    ):
+        option = compression.get_compress_option(level, threads, long_distance, window_log)
+        start = time.perf_counter()
+        compressed = pyzstd.compress(data, option)
+        elapsed = time.perf_counter() - start
+        assert pyzstd.decompress(compressed, option=compression.DECOMPRESS_OPTION) == data
+        print(f"| {level} | {threads} | {'yes' if long_distance else 'no'} | {window_log or 'default'} "
+              f"| {len(data) / 2**20 / elapsed:.1f} | {len(data) / len(compressed):.2f} |")
+
+
+if __name__ == "__main__":
+    main()